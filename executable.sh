@@ -1,8 +1,5 @@
 #!/bin/bash
 # Julio Ayala, Pinar Oncel, Mara Vizitiu
 # Run this script to generate all files and plot at once.
-python src/MSA.py data/mtdna_orig.fasta data/weights.txt results/MSAmtdna.txt
-python src/MSA.py data/y_chromosome_orig.fasta data/weights.txt results/MSAYchr.txt
-python src/SimilarityMatrix.py results/MSAmtdna.txt results/output_id_mtdna.txt results/output_score_mtdna.txt
-python src/SimilarityMatrix.py results/MSAYchr.txt results/output_id_ychr.txt results/output_score_ychr.txt
-python src/Dendrogram.py results/output_id_ychr.txt results/output_score_ychr.txt results/output_id_mtdna.txt results/output_score_mtdna.txt
+# The scripts can still be run one by one: src/MSA.py, src/SimilarityMatrix.py and src/Dendrogram.py
+python src/Pipeline.py -w data/weights.txt -r results -t 'Y Chromosome' -t 'mtDNA' Ychr=data/y_chromosome_orig.fasta mtdna=data/mtdna_orig.fasta
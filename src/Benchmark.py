@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+'''
+Benchmark.py
+Date: 2026-10-18
+Description: Script to measure the time and peak memory of every step of the
+analysis on synthetic alignments of growing size. The alignments are generated
+from a random ancestor sequence with a given rate of mutations (split into
+transitions and transversions), gaps and unknown nucleotides. The results are
+saved to a JSON file, and can be compared against a baseline file to find
+regressions.
+Usage: Benchmark.py [-h] [-n sizes] [-L lengths] [--gap-rate rate]
+        [--unknown-rate rate] [--mutation-rate rate] [--transition-ratio ratio]
+        [--seed seed] [-r repeat] [-o output_file] [-c baseline_file]
+        [--tolerance tolerance] [--min-seconds seconds] [--min-bytes bytes]
+        [-g fasta_file] [--max-python-cells cells]
+        [-w weights_file]
+Examples: python3 Benchmark.py -n 50,200,800 -L 100,1000 -o benchmark.json
+          python3 Benchmark.py -n 50,200,800 -L 100,1000 -c benchmark.json -o current.json
+          python3 Benchmark.py -n 1000 -L 16000 -g synthetic.fasta
+Arguments:
+    - [-n sizes]: Comma separated numbers of sequences. Defaults to 20,100
+    - [-L lengths]: Comma separated alignment lengths. Defaults to 100,1000
+    - [--gap-rate rate]: Fraction of gaps ('-') in the sequences. Defaults to 0.05
+    - [--unknown-rate rate]: Fraction of unknown nucleotides ('?'). Defaults to 0.02
+    - [--mutation-rate rate]: Fraction of nucleotides differing from the ancestor. Defaults to 0.1
+    - [--transition-ratio ratio]: Fraction of the mutations that are transitions. Defaults to 0.7
+    - [--seed seed]: Seed of the random generator. Defaults to 0
+    - [-r repeat]: Number of timed runs per step, the fastest one is kept. Defaults to 3
+    - [-o output_file]: JSON file for the results. Defaults to benchmark.json
+    - [-c baseline_file]: JSON file of an earlier run. Steps slower or using more
+                          memory than the baseline by more than the tolerance are
+                          reported, and the script exits with status 1. It must not
+                          be the output file, which would overwrite it.
+    - [--tolerance tolerance]: Allowed relative increase over the baseline. Defaults to 0.25
+    - [--min-seconds seconds]: Smallest slowdown counted as a regression, so that the
+                               noise of very short steps is not reported. Defaults to 0.01
+    - [--min-bytes bytes]: Smallest increase of the peak memory counted as a regression.
+                           Defaults to 1048576 (1 MiB)
+    - [-g fasta_file]: Only write a synthetic alignment with the first size and length.
+    - [--max-python-cells cells]: Largest number of alignment cells (pairs x length) scored
+                                  with the pure Python score_alignment_identity. Defaults to 2000000
+    - [-w weights_file]: File with the weights used for alignment scoring, in the
+                         format of MSA.py. Defaults to data/weights.txt
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import MSA
+import SimilarityMatrix as sm
+import Dendrogram
+
+BASES = np.array(list('AGCT'))  # purines first, then pyrimidines
+
+def make_alignment(n_seqs, length, gap_rate = 0.05, unknown_rate = 0.02, mutation_rate = 0.1,
+                   transition_ratio = 0.7, seed = 0):
+    '''
+    Function to generate a synthetic alignment from a random ancestor sequence.
+    Arguments:
+        n_seqs: Number of sequences.
+        length: Alignment length.
+        gap_rate: Fraction of gaps in the sequences.
+        unknown_rate: Fraction of unknown nucleotides.
+        mutation_rate: Fraction of nucleotides differing from the ancestor.
+        transition_ratio: Fraction of the mutations that are transitions.
+        seed: Seed of the random generator.
+    Returns:
+        records: List of (sequence ID, sequence).
+    '''
+    rng = np.random.default_rng(seed)
+    ancestor = rng.integers(0, 4, length)   # index in BASES
+    records = []
+    for i in range(n_seqs):
+        seq = ancestor.copy()
+        mutated = rng.random(length) < mutation_rate
+        transition = mutated & (rng.random(length) < transition_ratio)
+        transversion = mutated & ~transition
+        seq[transition] ^= 1                # A <-> G and C <-> T
+        # a transversion moves to one of the two bases of the other group
+        seq[transversion] = (seq[transversion] // 2 * 2 + 2 + rng.integers(0, 2, transversion.sum())) % 4
+        chars = BASES[seq]
+        draw = rng.random(length)
+        chars[draw < gap_rate] = '-'
+        chars[(draw >= gap_rate) & (draw < gap_rate + unknown_rate)] = '?'
+        records.append(('seq{}'.format(i), ''.join(chars)))
+    return records
+
+def write_fasta(fasta_file, records, width = 60):
+    '''
+    Function to write records to a fasta file, wrapping the sequences.
+    Arguments:
+        fasta_file: Path of the output file.
+        records: List of (sequence ID, sequence).
+        width: Number of nucleotides per line, or None for one line per sequence.
+    '''
+    with open(fasta_file, 'w') as fasta:
+        for seq_id, seq in records:
+            fasta.write('>' + seq_id + '\n')
+            step = width or max(1, len(seq))
+            for start in range(0, len(seq), step):
+                fasta.write(seq[start:start + step] + '\n')
+
+def measure(function, repeat = 3):
+    '''
+    Function to time a function and find its peak of traced memory.
+    Arguments:
+        function: Function without arguments.
+        repeat: Number of timed runs, the fastest one is kept.
+    Returns:
+        result: Value returned by the function.
+        seconds: Time of the fastest run.
+        peak_bytes: Peak memory allocated during one extra traced run.
+    '''
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()     # tracing slows the run down, so it is not timed
+    try:
+        function()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak_bytes
+
+def _all_pairs_python(records, weights):
+    '''
+    Function to score all pairs with the reference score_alignment_identity.
+    '''
+    return [MSA.score_alignment_identity(seq_1, seq_2, weights)
+            for i, (key_1, seq_1) in enumerate(records)
+            for key_2, seq_2 in records[i + 1:]]
+
+def run_size(n_seqs, length, weights, workdir, options):
+    '''
+    Function to benchmark every step of the analysis on one synthetic alignment.
+    Arguments:
+        n_seqs: Number of sequences.
+        length: Alignment length.
+        weights: Dictionary with the weights used for alignment scoring.
+        workdir: Directory for the intermediate files.
+        options: Parsed command line arguments.
+    Returns:
+        results: List of dictionaries with the step, size, seconds and peak memory.
+    '''
+    records = make_alignment(n_seqs, length, options.gap_rate, options.unknown_rate,
+                             options.mutation_rate, options.transition_ratio, options.seed)
+    fasta_file = os.path.join(workdir, 'alignment.fasta')
+    msa_file = os.path.join(workdir, 'msa.txt')
+    matrix_file = os.path.join(workdir, 'matrix.txt')
+    write_fasta(fasta_file, records)
+    alignment = MSA.read_alignment(fasta_file)
+    tables = MSA.build_lookup_tables(weights)
+    packed = MSA.pack_sequences(alignment.codes)
+    MSA.write_pairwise_text(msa_file, alignment.ids, MSA.score_all_pairs(alignment.codes, tables),
+                            alignment.length)
+    identity, score = sm.msa_to_dict(msa_file)
+    sm.make_matrix_file(identity, matrix_file)
+
+    steps = [
+        ('fasta_to_dict', lambda: MSA.fasta_to_dict(fasta_file)),
+        ('read_alignment', lambda: MSA.read_alignment(fasta_file)),
+        ('score_all_pairs', lambda: MSA.collect_condensed(
+            len(alignment), MSA.score_all_pairs(alignment.codes, tables), alignment.length)),
+        ('compressed_pairs', lambda: MSA.collect_condensed(
+            len(alignment), MSA.compressed_pairs(alignment.codes, tables), alignment.length)),
+        ('bitpacked_pairs', lambda: MSA.collect_condensed(
+            len(alignment), MSA.score_packed_pairs(packed, MSA.packed_coefficients(weights)), alignment.length)),
+        ('msa_to_dict', lambda: sm.msa_to_dict(msa_file)),
+        ('make_matrix_file', lambda: sm.make_matrix_file(identity, matrix_file)),
+        ('get_most_similar', lambda: [sm.get_most_similar(identity, name) for name in identity]),
+        ('create_clusters', lambda: Dendrogram.create_clusters(matrix_file)),
+    ]
+    if n_seqs * (n_seqs - 1) // 2 * length <= options.max_python_cells:
+        steps.insert(2, ('score_alignment_identity', lambda: _all_pairs_python(records, weights)))
+
+    results = []
+    for step, function in steps:
+        result, seconds, peak_bytes = measure(function, options.repeat)
+        results.append({'step': step, 'n_seqs': n_seqs, 'length': length,
+                        'seconds': seconds, 'peak_bytes': peak_bytes})
+        print('{:<26}n={:<8}L={:<9}{:>10.4f} s{:>12.1f} MiB'.format(
+            step, n_seqs, length, seconds, peak_bytes / 2 ** 20))
+    return results
+
+def compare(results, baseline, tolerance, min_seconds = 0.0, min_bytes = 0):
+    '''
+    Function to find the steps that got slower or use more memory than in a baseline.
+    Arguments:
+        results: List of results of this run.
+        baseline: List of results of the baseline run.
+        tolerance: Allowed relative increase over the baseline.
+        min_seconds: Smallest increase of the time counted as a regression, whatever the tolerance.
+        min_bytes: Smallest increase of the peak memory counted as a regression, whatever the tolerance.
+    Returns:
+        regressions: List of messages, one per regression.
+    '''
+    reference = {(item['step'], item['n_seqs'], item['length']): item for item in baseline}
+    regressions = []
+    for item in results:
+        old = reference.get((item['step'], item['n_seqs'], item['length']))
+        if old is None:
+            continue
+        # very short steps and small allocations vary from run to run by more than the tolerance
+        for measure_name, floor in (('seconds', min_seconds), ('peak_bytes', min_bytes)):
+            if item[measure_name] > old[measure_name] * (1 + tolerance) and item[measure_name] - old[measure_name] > floor:
+                regressions.append('{} (n={}, L={}): {} went from {:.6g} to {:.6g}'.format(
+                    item['step'], item['n_seqs'], item['length'], measure_name,
+                    old[measure_name], item[measure_name]))
+    return regressions
+
+def _int_list(text):
+    return [int(value) for value in text.split(',')]
+
+def main(argv = None):
+    '''
+    Function to run the script with command line arguments.
+    Arguments:
+        argv: List of arguments, defaults to sys.argv[1:].
+    '''
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('-n', dest = 'sizes', type = _int_list, default = [20, 100], help = 'numbers of sequences')
+    p.add_argument('-L', dest = 'lengths', type = _int_list, default = [100, 1000], help = 'alignment lengths')
+    p.add_argument('--gap-rate', dest = 'gap_rate', type = float, default = 0.05)
+    p.add_argument('--unknown-rate', dest = 'unknown_rate', type = float, default = 0.02)
+    p.add_argument('--mutation-rate', dest = 'mutation_rate', type = float, default = 0.1)
+    p.add_argument('--transition-ratio', dest = 'transition_ratio', type = float, default = 0.7)
+    p.add_argument('--seed', dest = 'seed', type = int, default = 0)
+    p.add_argument('-r', dest = 'repeat', type = int, default = 3, help = 'timed runs per step')
+    p.add_argument('-o', dest = 'output_file', default = 'benchmark.json', help = 'JSON file for the results')
+    p.add_argument('-c', dest = 'baseline_file', help = 'JSON file of a baseline run')
+    p.add_argument('--tolerance', dest = 'tolerance', type = float, default = 0.25)
+    p.add_argument('--min-seconds', dest = 'min_seconds', type = float, default = 0.01,
+                   help = 'smallest slowdown counted as a regression. Default is 0.01')
+    p.add_argument('--min-bytes', dest = 'min_bytes', type = int, default = 1 << 20,
+                   help = 'smallest increase of the peak memory counted as a regression. Default is 1048576')
+    p.add_argument('-g', dest = 'fasta_file', help = 'only write a synthetic alignment to this file')
+    p.add_argument('--max-python-cells', dest = 'max_python_cells', type = int, default = 2000000)
+    p.add_argument('-w', dest = 'weights_file',
+                   default = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'weights.txt'),
+                   help = 'file with the weights. Defaults to data/weights.txt')
+    args = p.parse_args(argv)
+    if args.baseline_file and os.path.realpath(args.baseline_file) == os.path.realpath(args.output_file):
+        p.error('the baseline file would be overwritten by the results, choose another output file with -o')
+
+    if args.fasta_file:
+        write_fasta(args.fasta_file, make_alignment(args.sizes[0], args.lengths[0], args.gap_rate,
+                                                    args.unknown_rate, args.mutation_rate,
+                                                    args.transition_ratio, args.seed))
+        return 0
+
+    weights = MSA.read_weights(args.weights_file)
+    baseline = None
+    if args.baseline_file:      # read before the run, so a missing or broken baseline fails early
+        with open(args.baseline_file, 'r') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_seqs in args.sizes:
+            for length in args.lengths:
+                results.extend(run_size(n_seqs, length, weights, workdir, args))
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'settings': {name: getattr(args, name) for name in
+                     ('gap_rate', 'unknown_rate', 'mutation_rate', 'transition_ratio', 'seed', 'repeat')},
+        'results': results,
+    }
+    with open(args.output_file, 'w') as output:
+        json.dump(report, output, indent = 1)
+
+    if baseline is not None:
+        keys = {(item['step'], item['n_seqs'], item['length']) for item in baseline}
+        if not any((item['step'], item['n_seqs'], item['length']) in keys for item in results):
+            print('No step of this run was measured in ' + args.baseline_file)
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds, args.min_bytes)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            return 1
+        print('No regressions against ' + args.baseline_file)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
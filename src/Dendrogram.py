@@ -7,63 +7,399 @@ Description: Script to create dendograms using hierarchical clustering from the
 scipy cluster package. The script receives files with similarity matrices, and
 builds a hierarchical cluster using the linkage function. Then, a dendogram is
 plotted for all matrices given, and saved to an external file.
-Usage: dendogram.py [-h] [-m method]
-        matrix_file_1 matrix_file_2 matrix_file_3 matrix_file_4
+Usage: dendogram.py [-h] [-m method] [-d] [-l] [-t title] [-t title ...]
+        [-s suptitle] [-o output_dir] [-p max_leaves] [--metrics metrics_file]
+        matrix_file [matrix_file ...]
 Arguments:
-    - matrix_file_1: File with the first similarity matrix. For Running Exercise
-        3 from BINP16, this corresponds to the Y chromosome identity matrix
-    - matrix_file_2: File with the first similarity matrix. For Running Exercise
-        3 from BINP16, this corresponds to the Y chromosome scoring matrix
-    - matrix_file_3: File with the first similarity matrix. For Running Exercise
-        3 from BINP16, this corresponds to the mtdna identity matrix
-    - matrix_file_4: File with the first similarity matrix. For Running Exercise
-        3 from BINP16, this corresponds to the mtdna scoring matrix
+    - matrix_file: Files with the similarity matrices. For Running Exercise 3
+        from BINP16, these are the Y chromosome identity and scoring matrices,
+        followed by the mtdna identity and scoring matrices
     - [-m method]: Method for the linkage hierarchical clustering. Defaults to single.
                     Values: single, average, weighted, centroid, median, ward
+    - [-d]: Cluster on the condensed distances 100 - similarity instead of using
+            the rows of the matrices as observation vectors.
+    - [-l]: Use the memory-efficient O(N^2) linkage on condensed distances for
+            single and average methods (implies -d). Meant for tens of thousands
+            of sequences. Single linkage keeps float32 distances: it only compares
+            them, so it merges the same clusters as scipy, with heights rounded to
+            float32. Average linkage keeps float64 distances, so that its updates
+            are rounded as in scipy and give the same trees.
+    - [-t title]: Title of a dendrogram, given once per matrix file in the same
+                  order. Defaults to the matrix file names.
+    - [-s suptitle]: Title of the whole figure.
+    - [-o output_dir]: Save the figure, and the Newick trees and linkage arrays
+                       of every matrix, to this directory instead of showing
+                       the figure.
+    - [-p max_leaves]: Largest number of leaves drawn in a dendrogram. Larger
+                       trees only show their last merged clusters. Defaults to 200
+    - [--metrics metrics_file]: Append the time, memory and counters of every
+                                stage to this file as JSON lines ('-' for stderr).
 
 '''
 
-import sys
+import os
 import argparse
+import numpy as np
 from scipy.cluster.hierarchy import dendrogram, linkage
 from matplotlib import pyplot as plt
+import MSA
+import Metrics
 
-def create_clusters(input_file, cluster_method = 'single'):
+# methods supported by the memory-efficient linkage, with the type of their distances:
+# single linkage only compares distances, while average linkage computes new ones,
+# which float32 would round differently from scipy and so break near-ties differently
+LOW_MEMORY_METHODS = {'single': np.float32, 'average': np.float64}
+
+def _matrix_rows(input_file):
+    '''
+    Function to read the rows of a similarity matrix file one at a time.
+    Arguments:
+        input_file: Similarity matrix in a tab delimited file.
+    Returns:
+        Generator of (label, array with the values of the row).
+    '''
+    with open(input_file, 'r') as matrix_file:
+        header = next(matrix_file)
+        for line in matrix_file:
+            line = line.strip().split()
+            # first column is the label, the rest of columns are the values
+            yield line[0], np.array(line[1:], dtype=np.float64)
+
+def read_matrix(input_file):
+    '''
+    Function to read a similarity matrix file written by SimilarityMatrix.py.
+    Arguments:
+        input_file: Similarity matrix in a tab delimited file.
+    Returns:
+        labels: List of labels of the matrix file.
+        data: Array (float64) with the values of the matrix.
+    '''
+    labels = []
+    rows = []
+    for label, row in _matrix_rows(input_file):
+        labels.append(label)
+        rows.append(row)
+    data = np.array(rows, dtype=np.float64).reshape(len(labels), len(labels))
+    return labels, data
+
+def similarity_to_distance(rows, n, dtype=np.float64):
+    '''
+    Function to convert the rows of a square similarity matrix (percentages) into a
+    condensed distance vector, in the order used by scipy. Only the upper triangle of
+    each row is kept, so the rows can be streamed from a file.
+    Arguments:
+        rows: Iterable with the rows of the similarity matrix.
+        n: Number of rows.
+        dtype: Type of the distances.
+    Returns:
+        distances: Condensed upper triangle of 100 - similarity.
+    '''
+    distances = np.empty(n * (n - 1) // 2, dtype=dtype)
+    for i, row in enumerate(rows):
+        if i < n - 1:
+            start = MSA.condensed_index(i, n)
+            distances[start:start + n - i - 1] = 100 - row[i + 1:]
+    np.maximum(distances, 0, out=distances)  # similarities above 100 are not distances
+    return distances
+
+def read_distances(input_file, dtype=np.float64):
+    '''
+    Function to read a similarity matrix file directly into a condensed distance
+    vector, without keeping the square matrix in memory.
+    Arguments:
+        input_file: Similarity matrix in a tab delimited file.
+        dtype: Type of the distances.
+    Returns:
+        labels: List of labels of the matrix file.
+        distances: Condensed upper triangle of 100 - similarity.
+    '''
+    with open(input_file, 'r') as matrix_file:
+        n = len(next(matrix_file).split())  # the header holds one label per column
+    labels = []
+
+    def rows():
+        for label, row in _matrix_rows(input_file):
+            labels.append(label)
+            yield row
+
+    distances = similarity_to_distance(rows(), n, dtype)
+    return labels, distances
+
+def _distance_row(distances, n, i):
+    '''
+    Function to gather the distances of element i to all elements from a condensed vector.
+    '''
+    row = np.empty(n, dtype=np.float64)
+    before = np.arange(i)
+    row[:i] = distances[MSA.condensed_index(before, n) + i - before - 1]
+    row[i] = np.inf
+    start = MSA.condensed_index(i, n)
+    row[i + 1:] = distances[start:start + n - i - 1]
+    return row
+
+def _label_merges(merges, n):
+    '''
+    Function to sort the merges by distance and relabel them as in scipy linkage arrays,
+    where the cluster formed at step k gets the id n + k.
+    Arguments:
+        merges: Array (n - 1 x 3) with the two merged elements and their distance.
+        n: Number of observations.
+    Returns:
+        clusters: Linkage array (n - 1 x 4).
+    '''
+    merges = merges[np.argsort(merges[:, 2], kind='mergesort')]
+    parent = np.arange(2 * n - 1)   # union-find over observations and clusters
+    size = np.ones(2 * n - 1)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:    # path compression
+            parent[x], x = root, parent[x]
+        return root
+
+    clusters = np.empty((n - 1, 4))
+    for k, (a, b, dist) in enumerate(merges):
+        x, y = find(int(a)), find(int(b))
+        x, y = min(x, y), max(x, y)
+        parent[x] = parent[y] = n + k
+        size[n + k] = size[x] + size[y]
+        clusters[k] = x, y, dist, size[n + k]
+    return clusters
+
+def single_linkage(distances, n):
+    '''
+    Function to build a single linkage cluster from a condensed distance vector with
+    Prim's minimum spanning tree, in O(N^2) time and O(N) additional memory.
+    Arguments:
+        distances: Condensed distance vector (any float type, it is not modified).
+        n: Number of observations.
+    Returns:
+        clusters: Linkage array, as returned by scipy linkage.
+    '''
+    merged = np.zeros(n, dtype=bool)
+    best = np.full(n, np.inf)   # shortest distance of every element to the tree
+    nearest = np.zeros(n, dtype=np.int64)
+    merges = np.empty((n - 1, 3))
+    current = 0
+    merged[0] = True
+    for k in range(n - 1):
+        row = _distance_row(distances, n, current)
+        closer = ~merged & (row < best)
+        best[closer] = row[closer]
+        nearest[closer] = current
+        candidates = np.where(merged, np.inf, best)
+        current = int(np.argmin(candidates))
+        merges[k] = nearest[current], current, best[current]
+        merged[current] = True
+    return _label_merges(merges, n)
+
+def average_linkage(distances, n):
+    '''
+    Function to build an average linkage cluster from a condensed distance vector with
+    the nearest-neighbour chain algorithm, in O(N^2) time. The distances are updated in
+    place, so no copy of the vector is made.
+    Arguments:
+        distances: Condensed distance vector, overwritten. Use float64 to match scipy, which
+                   computes the updates in float64: float32 rounds them and breaks near-ties differently.
+        n: Number of observations.
+    Returns:
+        clusters: Linkage array, as returned by scipy linkage.
+    '''
+    size = np.ones(n)
+    merges = np.empty((n - 1, 3))
+    chain = []
+    for k in range(n - 1):
+        if not chain:
+            chain.append(int(np.argmax(size > 0)))
+        while True:
+            x = chain[-1]
+            row = _distance_row(distances, n, x)
+            row[size == 0] = np.inf     # clusters already merged into others
+            y = int(np.argmin(row))
+            # on ties the previous element of the chain is kept, so the chain always ends
+            if len(chain) > 1 and row[chain[-2]] <= row[y]:
+                y = chain[-2]
+                break
+            chain.append(y)
+        del chain[-2:]
+        dist = row[y]
+        x, y = min(x, y), max(x, y)
+        merges[k] = x, y, dist
+        # Lance-Williams update: y now stands for the merged cluster
+        row_x = _distance_row(distances, n, x)
+        row_y = _distance_row(distances, n, y)
+        updated = (size[x] * row_x + size[y] * row_y) / (size[x] + size[y])
+        size[y] += size[x]
+        size[x] = 0
+        others = np.flatnonzero(size > 0)
+        others = others[others != y]
+        low, high = np.minimum(others, y), np.maximum(others, y)
+        distances[MSA.condensed_index(low, n) + high - low - 1] = updated[others]
+    # scipy numbers the clusters by the merge order after sorting by distance
+    return _label_merges(merges, n)
+
+def create_clusters(input_file, cluster_method = 'single', distance = False, low_memory = False):
     '''
     Function to create a hierarchical cluster, given a matrix file. Returns an
     array with the relationships between sequences.
     Arguments:
         input_file: Similarity matrix in a tab delimited file.
         cluster_method: Method used for the linkage function.
+        distance: Cluster on the condensed distances 100 - similarity, instead of
+                  using the rows of the matrix as observation vectors.
+        low_memory: Use the memory-efficient linkage on condensed distances, for the
+                    single and average methods (see LOW_MEMORY_METHODS). Implies distance.
     Returns:
         clusters: Array with the scores of relationships among sequences.
         labels: List of labels of the matrix file.
     '''
-    #Initializing variables for the parsing of the file.
-    data = []
-    labels = []
-    with open(input_file, 'r') as matrix_file:
-        header = next(matrix_file)
-        for line in matrix_file:
-            line = line.strip().split()
-            labels.append(line[0])  # first column is added to the labels
-            row = []
-            for i in range(1, len(line)):
-                row.append(float(line[i]))  #The rest of columns are converted to float and added to the data
-            data.append(row)
-    # The linkage function is used to create the hierarchical cluster of the given data.
-    clusters = linkage(data, method = cluster_method)
+    with Metrics.stage('create_clusters') as counters:
+        if low_memory:
+            labels, distances = read_distances(input_file, LOW_MEMORY_METHODS.get(cluster_method, np.float64))
+            clusters = _linkage_low_memory(distances, len(labels), cluster_method)
+        elif distance:
+            labels, distances = read_distances(input_file)
+            clusters = linkage(distances, method = cluster_method)
+        else:
+            labels, data = read_matrix(input_file)
+            # The linkage function is used to create the hierarchical cluster of the given data.
+            clusters = linkage(data, method = cluster_method)
+        counters.update(input_file = input_file, method = cluster_method, sequences = len(labels),
+                        merges = len(clusters))
     return clusters, labels
 
+def _linkage_low_memory(distances, n, cluster_method):
+    '''
+    Function to run the memory-efficient linkage of a method on condensed distances.
+    '''
+    if cluster_method not in LOW_MEMORY_METHODS:
+        raise ValueError('the low memory linkage only supports the methods {}'.format(
+            ', '.join(LOW_MEMORY_METHODS)))
+    if cluster_method == 'single':
+        return single_linkage(distances, n)
+    return average_linkage(distances, n)
 
-if __name__ == '__main__':
-    # The list of arguments is added. (Matrix 1 through 4)
+def cluster_matrix(data, cluster_method = 'single', distance = False, low_memory = False):
+    '''
+    Function to create a hierarchical cluster from a similarity matrix held in memory,
+    with the same options as create_clusters.
+    Arguments:
+        data: Square similarity matrix (array).
+        cluster_method: Method used for the linkage function.
+        distance: Cluster on the condensed distances 100 - similarity.
+        low_memory: Use the memory-efficient linkage on condensed distances.
+    Returns:
+        clusters: Array with the scores of relationships among sequences.
+    '''
+    with Metrics.stage('cluster_matrix') as counters:
+        if low_memory:
+            distances = similarity_to_distance(data, len(data), LOW_MEMORY_METHODS.get(cluster_method, np.float64))
+            clusters = _linkage_low_memory(distances, len(data), cluster_method)
+        elif distance:
+            clusters = linkage(similarity_to_distance(data, len(data)), method = cluster_method)
+        else:
+            clusters = linkage(data, method = cluster_method)
+        counters.update(method = cluster_method, sequences = len(data), merges = len(clusters))
+    return clusters
+
+def _newick_label(label):
+    '''
+    Function to quote a label when it has characters with a meaning in the Newick format.
+    '''
+    if any(char in label for char in " ()[]':;,"):
+        return "'" + label.replace("'", "''") + "'"
+    return label
+
+def to_newick(clusters, labels):
+    '''
+    Function to convert a linkage array into a tree in Newick format, with branch lengths.
+    Arguments:
+        clusters: Linkage array.
+        labels: List of labels of the observations.
+    Returns:
+        newick: Tree in Newick format (str).
+    '''
+    n = len(labels)
+    if n == 1:
+        return _newick_label(labels[0]) + ';'
+    heights = np.zeros(2 * n - 1)
+    heights[n:] = clusters[:, 2]
+    parts = []
+    stack = [2 * n - 2]     # explicit stack instead of recursion, for deep trees
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+        elif item < n:
+            parts.append(_newick_label(labels[item]))
+        else:
+            left, right = int(clusters[item - n, 0]), int(clusters[item - n, 1])
+            height = heights[item]
+            stack.extend([')', ':{:g}'.format(height - heights[right]), right, ',',
+                          ':{:g}'.format(height - heights[left]), left, '('])
+    return ''.join(parts) + ';'
+
+def save_clusters(clusters, labels, prefix):
+    '''
+    Function to save a linkage array and its tree in Newick format.
+    Arguments:
+        clusters: Linkage array.
+        labels: List of labels of the observations.
+        prefix: Path of the output files, without extension.
+    '''
+    np.save(prefix + '.linkage.npy', clusters)
+    with open(prefix + '.newick', 'w') as newick_file:
+        newick_file.write(to_newick(clusters, labels) + '\n')
+
+
+def plot_dendrograms(results, titles, suptitle, max_leaves = 200, output_file = None):
+    '''
+    Function to plot the dendrograms of several clusters in one figure.
+    Arguments:
+        results: List of (clusters, labels), one per dendrogram.
+        titles: List of titles, one per dendrogram.
+        suptitle: Title of the figure.
+        max_leaves: Largest number of leaves drawn in a dendrogram. Larger trees
+                    only show their last merged clusters.
+        output_file: File to save the figure to, instead of showing it.
+    '''
+    if output_file:
+        plt.switch_backend('Agg')   # no display is needed to save the figure
+    # Create a figure with one subplot per dendrogram
+    columns = int(np.ceil(np.sqrt(len(results))))
+    rows = int(np.ceil(len(results) / columns))
+    figure = plt.figure(figsize=(5 * columns, 5 * rows))
+    plt.suptitle(suptitle)
+    for position, ((clusters, labels), title) in enumerate(zip(results, titles), 1):
+        plt.subplot(rows, columns, position) #Adding position in the subplot
+        plt.title(title)
+        if len(labels) > max_leaves:   # Large trees only show their last merged clusters
+            dendrogram(clusters
+                       , truncate_mode = 'lastp'
+                       , p = max_leaves
+                       , orientation = 'left')
+        else:
+            dendrogram(clusters
+                       , labels=labels
+                       , orientation = 'left') # Setting orientation of the labels/tree
+    if output_file:
+        plt.savefig(output_file)
+        plt.close(figure)
+    else:
+        plt.show() # Plotting the figure
+
+def main(argv = None):
+    '''
+    Function to run the script with command line arguments.
+    Arguments:
+        argv: List of arguments, defaults to sys.argv[1:].
+    '''
+    # The list of arguments is added (one or more matrix files)
     p = argparse.ArgumentParser(description=__doc__,
                             formatter_class=argparse.RawDescriptionHelpFormatter)
-    p.add_argument('matrix_file_1', help = 'matrix file 1',)
-    p.add_argument('matrix_file_2', help = 'matrix file 1',)
-    p.add_argument('matrix_file_3', help = 'matrix file 1',)
-    p.add_argument('matrix_file_4', help = 'matrix file 1',)
+    p.add_argument('matrix_files', nargs = '+', metavar = 'matrix_file', help = 'matrix files')
     # Argument for the clustering method used. Defaults to single
     p.add_argument (
         '-m',
@@ -72,40 +408,39 @@ if __name__ == '__main__':
         choices = ['single', 'average', 'weighted', 'centroid', 'median', 'ward'],
         default = 'single'
     )
-    args = p.parse_args()
-
-    # Build the clusters for all 4 matrix files
-    clusters_id_ychr, labels_id_ychr = create_clusters(args.matrix_file_1, args.method)
-    clusters_score_ychr, labels_score_ychr = create_clusters(args.matrix_file_2, args.method)
-    clusters_id_mtdna, labels_id_mtdna = create_clusters(args.matrix_file_3, args.method)
-    clusters_score_mtdna, labels_score_mtdna = create_clusters(args.matrix_file_4, args.method)
-
-    # Create a figure with 4 subplots (2x2)
-    plt.figure(figsize=(10,10))
-    plt.suptitle('Hierarchical clustering dendograms for Y chromosome and mtDNA sequences')
-    # Create dendogram for the Y Chromosome identity matrix
-    plt.subplot(2,2,1) #Adding position in the subplot
-    plt.title('Y Chromosome identity')
-    dendrogram(clusters_id_ychr
-               , labels=labels_id_ychr
-               , orientation = 'left') # Setting orientation of the labels/tree
-   # Create dendogram for the Y Chromosome scoring matrix
-    plt.subplot(2,2,2)
-    plt.title('Y Chromosome score')
-    dendrogram(clusters_score_ychr
-               , labels=labels_score_ychr
-               , orientation = 'left')
-   # Create dendogram for the mtDNA identity matrix
-    plt.subplot(2,2,3)
-    plt.title('mtDNA identity')
-    dendrogram(clusters_id_mtdna
-                , labels=labels_id_mtdna
-                , orientation = 'left')
-    # Create dendogram for the mtDNA scoring matrix
-    plt.subplot(2,2,4)
-    plt.title('mtDNA score')
-    dendrogram(clusters_score_mtdna
-                , labels=labels_score_mtdna
-                , orientation = 'left')
-
-    plt.show() # Plotting the figure
+    p.add_argument('-d', dest = 'distance', action = 'store_true',
+                   help = 'cluster on the condensed distances 100 - similarity')
+    p.add_argument('-l', dest = 'low_memory', action = 'store_true',
+                   help = 'memory-efficient linkage for single and average methods')
+    p.add_argument('-t', dest = 'titles', action = 'append',
+                   help = 'title of a dendrogram, given once per matrix file in the same order')
+    p.add_argument('-s', dest = 'suptitle',
+                   default = 'Hierarchical clustering dendograms for Y chromosome and mtDNA sequences',
+                   help = 'title of the figure')
+    p.add_argument('-o', dest = 'output_dir', help = 'save the results to this directory')
+    p.add_argument('-p', dest = 'max_leaves', type = int, default = 200,
+                   help = 'largest number of leaves drawn in a dendrogram. Default is 200')
+    p.add_argument('--metrics', dest = 'metrics', help = 'append the metrics of every stage to this file as JSON lines')
+    args = p.parse_args(argv)
+    Metrics.configure(args.metrics)
+    if args.low_memory and args.method not in LOW_MEMORY_METHODS:
+        p.error('-l only supports the methods ' + ', '.join(LOW_MEMORY_METHODS))
+    titles = args.titles or [os.path.splitext(os.path.basename(name))[0] for name in args.matrix_files]
+    if len(titles) != len(args.matrix_files):
+        p.error('one title is needed per matrix file')
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok = True)
+
+    results = []
+    for matrix_file in args.matrix_files:
+        # Build the clusters for the matrix file
+        clusters, labels = create_clusters(matrix_file, args.method, args.distance, args.low_memory)
+        if args.output_dir:
+            prefix = os.path.splitext(os.path.basename(matrix_file))[0]
+            save_clusters(clusters, labels, os.path.join(args.output_dir, prefix))
+        results.append((clusters, labels))
+    output_file = os.path.join(args.output_dir, 'dendrograms.png') if args.output_dir else None
+    plot_dendrograms(results, titles, args.suptitle, args.max_leaves, output_file)
+
+if __name__ == '__main__':
+    main()
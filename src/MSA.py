@@ -10,6 +10,7 @@ Description : this is a script to calculate identity and alignment scores for ea
 
 Usage1 : mitochondrial DNA sequences : python3 MSA.py ../data/mtdna_orig.fasta ../data/weights.txt ../results/MSAmtdna.txt
 Usage2 : Y chromosome sequences :      python3 MSA.py ../data/y_chromosome_orig.fasta ../data/weights.txt ../results/MSAYchr.txt
+Usage3 : on several cores :            python3 MSA.py -j 8 ../data/mtdna_orig.fasta ../data/weights.txt ../results/MSAmtdna.txt
 
 Arguments :
 - mtdna_orig.fasta :        an input file in fasta format containing aligned mitochondrial DNA sequences
@@ -18,9 +19,41 @@ Arguments :
 weight types and weight values are separated by a tab in one line : (1)match:1 (2)transition:-1 (3)transversion:-2 (4)gap:-1
 - MSAmtdna.txt :            an output file including pairs of sequences and their respective identity scores
 - MSAYchr.txt :             an output file including pairs of sequences and their respective alignment scores
+- [-j jobs] :               number of worker processes used to score the pairs. Defaults to 1
+- [-f format] :             format of the output file: text, or npz for condensed binary arrays.
+                            Defaults to npz when the output file ends with .npz, text otherwise
+- [--mmap] :                memory-map the fasta file while reading it
+- [--cache cache.npz] :     file keeping the scores of every pair of sequences between runs, keyed by a hash of
+                            the sequence content and of the weights. Only the pairs of new sequences are scored,
+                            and appended in place to cache.npz.identical.npy and cache.npz.score.npy
+- [--delta delta.npz] :     output file with only the pairs involving sequences that are new or changed since the
+                            last run with the same cache, used by SimilarityMatrix.py to update its matrices
+- [-z, --compress] :        score each distinct sequence once, over the distinct column patterns of the alignment
+                            weighted by the number of columns they stand for. Gives the same scores, much faster
+                            on long alignments with few variable sites or many duplicated sequences
+- [-b, --bitpacked] :       hold the sequences as bit planes of 64-bit words, 4 bits per nucleotide, and count
+                            matches, transitions, transversions and gaps of 64 columns at a time with bitwise
+                            operations. Only for sequences of A, C, G, T, ? and -, others are scored as usual
+- [--metrics metrics.jsonl] : append the time, CPU time, peak memory and counters of every stage to this file as
+                            JSON lines ('-' for stderr)
+- [--progress] :            print the progress of the pairwise scoring and its estimated remaining time to stderr
+Sequences in the fasta file may be wrapped over several lines, and must all have the same length.
 '''
 
-import sys
+import os
+import mmap
+import hashlib
+import argparse
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
+import Metrics
+
+ALPHABET_SIZE = 128   # sequences are encoded as ASCII codes
+BLOCK_CELLS = 1 << 22 # maximum number of alignment cells scored at once by score_block
+MAX_TILE = 256        # maximum number of sequences per side of an all-pairs tile
+TASKS_PER_JOB = 4     # tasks submitted ahead per worker process, see _bounded_imap
+PACKED_CHARACTERS = 'ACGT?-' # characters of the alignments that can be bit-packed
 
 def score_alignment_identity(seq_1, seq_2, weights):
     '''
@@ -56,37 +89,1166 @@ def score_alignment_identity(seq_1, seq_2, weights):
     identity = round(100 * identical / len(seq_1), 1) # divide nr of identical by length
     return identity, score                            # return score and identity as a tuple
 
+def _read_fasta_lines(fasta_file, use_mmap=False):
+    '''
+    this is a function to read the lines of a fasta file, optionally through a memory map
+    Arguments : fasta_file : path of the fasta file
+                use_mmap (bool) : memory-map the file instead of reading it through a buffer
+    Returns : generator of lines (bytes)
+    '''
+    with open(fasta_file, 'rb') as fasta:
+        if not use_mmap or os.fstat(fasta.fileno()).st_size == 0:  # empty files cannot be mapped
+            yield from fasta
+            return
+        with mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield from iter(mapped.readline, b'')
+
+def _iter_fasta_bytes(fasta_file, use_mmap=False):
+    '''
+    this is a function to stream the records of a fasta file, where sequences may be
+    wrapped over several lines
+    Arguments : fasta_file : path of the fasta file
+                use_mmap (bool) : memory-map the file instead of reading it through a buffer
+    Returns : generator of (sequence ID (str), upper case sequence (bytes))
+    '''
+    header = None
+    chunks = []
+    for line in _read_fasta_lines(fasta_file, use_mmap):
+        if line.startswith(b'>'):            # a new record starts
+            if header is not None:
+                yield header, b''.join(chunks)
+            header = line.strip()[1:].decode('utf-8')
+            chunks = []
+        elif header is not None:             # sequence line of the current record
+            chunks.append(line.strip().upper())
+    if header is not None:
+        yield header, b''.join(chunks)
+
+def iter_fasta(fasta_file, use_mmap=False):
+    '''
+    this is a function to lazily read the records of a fasta file
+    Arguments : fasta_file : path of the fasta file
+                use_mmap (bool) : memory-map the file instead of reading it through a buffer
+    Returns : generator of (sequence ID, upper case sequence) tuples of str
+    '''
+    for header, seq in _iter_fasta_bytes(fasta_file, use_mmap):
+        yield header, seq.decode('ascii')
+
 def fasta_to_dict(fasta_file):
     '''
     this is a function to convert a fasta file into a dictionary
     Arguments : fasta_file : file with fasta sequences, where the header delimiter is a tab
     Returns : dictionary with sequence IDs as keys, and sequences as values
     '''
-    sequences = {} # set up an empty dictionary to store sequence ID and sequence
-
-    # how to retrieve sequences from the fasta file
-    with open(fasta_file, 'r') as fasta:
-        for line in fasta:
-            if line.startswith('>'): # get ID and sequence and add to dictionary
-                header = line.strip()[1:]
-                sequences[header] = next(fasta).upper().strip()
+    with Metrics.stage('fasta_to_dict') as counters:
+        sequences = dict(iter_fasta(fasta_file))
+        counters['sequences'] = len(sequences)
+        counters['columns'] = len(next(iter(sequences.values()), ''))
     return sequences
 
-weights = {} # set up an empty dictionary to store weight type and value
+class EncodedAlignment:
+    '''
+    this is a class to hold aligned sequences encoded in one contiguous buffer
+    Attributes : ids (list) : sequence IDs in file order
+                 index (dict) : row of each sequence ID in codes
+                 codes (2D array) : encoded sequences, one per row (see encode_sequence)
+    '''
+    def __init__(self, ids, codes):
+        self.ids = ids
+        self.index = {seq_id: row for row, seq_id in enumerate(ids)}
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def length(self):
+        return self.codes.shape[1]
+
+    def sequence(self, seq_id):
+        return self.codes[self.index[seq_id]].tobytes().decode('ascii')
+
+    def records(self):
+        for seq_id, codes in zip(self.ids, self.codes):
+            yield seq_id, codes.tobytes().decode('ascii')
+
+def read_alignment(fasta_file, use_mmap=False):
+    '''
+    this is a function to read an aligned fasta file into one contiguous encoded buffer
+    Arguments : fasta_file : path of the fasta file
+                use_mmap (bool) : memory-map the file instead of reading it through a buffer
+    Returns : encoded alignment (EncodedAlignment)
+    '''
+    ids = []
+    seen = set()
+    buffer = bytearray() # encoded sequences, one after the other
+    length = None
+    for header, seq in _iter_fasta_bytes(fasta_file, use_mmap):
+        if header in seen:
+            raise ValueError('duplicated sequence ID {} in {}'.format(header, fasta_file))
+        if length is None:
+            length = len(seq)
+        elif len(seq) != length:
+            raise ValueError('sequence {} has length {} but the alignment has length {}'.format(
+                header, len(seq), length))
+        seen.add(header)
+        ids.append(header)
+        buffer += seq
+    codes = np.frombuffer(buffer, dtype=np.uint8).reshape(len(ids), length or 0)
+    if codes.size and codes.max() >= ALPHABET_SIZE:
+        raise ValueError('sequences in {} must only contain ASCII characters'.format(fasta_file))
+    return EncodedAlignment(ids, codes)
+
+class PackedAlignment:
+    '''
+    this is a class to hold aligned sequences bit-packed in 64-bit words (see pack_sequences), with
+    the same IDs, length, sequences and records as EncodedAlignment. The whole alignment is only
+    decoded on request, with unpack
+    Attributes : ids (list) : sequence IDs in file order
+                 index (dict) : row of each sequence ID in packed
+                 packed (3D array) : bit planes of every sequence
+                 length (int) : alignment length
+    '''
+    def __init__(self, ids, packed, length):
+        self.ids = ids
+        self.index = {seq_id: row for row, seq_id in enumerate(ids)}
+        self.packed = packed
+        self.length = length
+
+    def __len__(self):
+        return len(self.ids)
+
+    def unpack(self):
+        '''
+        this is a function to decode every sequence at once, one byte per nucleotide
+        Returns : encoded alignment (EncodedAlignment)
+        '''
+        return EncodedAlignment(self.ids, unpack_sequences(self.packed, self.length))
+
+    def sequence(self, seq_id):
+        row = self.index[seq_id]
+        return unpack_sequences(self.packed[row:row + 1], self.length)[0].tobytes().decode('ascii')
+
+    def records(self):
+        for row, seq_id in enumerate(self.ids):
+            yield seq_id, unpack_sequences(self.packed[row:row + 1], self.length)[0].tobytes().decode('ascii')
+
+def read_packed_alignment(fasta_file, use_mmap=False):
+    '''
+    this is a function to read an aligned fasta file straight into bit-packed sequences, so
+    that the whole alignment is never held one byte per nucleotide
+    Arguments : fasta_file : path of the fasta file
+                use_mmap (bool) : memory-map the file instead of reading it through a buffer
+    Returns : bit-packed alignment (PackedAlignment), or None when the sequences have
+              characters other than PACKED_CHARACTERS
+    '''
+    ids = []
+    seen = set()
+    packed = []          # bit planes of each sequence
+    length = None
+    for header, seq in _iter_fasta_bytes(fasta_file, use_mmap):
+        if header in seen:
+            raise ValueError('duplicated sequence ID {} in {}'.format(header, fasta_file))
+        if length is None:
+            length = len(seq)
+        elif len(seq) != length:
+            raise ValueError('sequence {} has length {} but the alignment has length {}'.format(
+                header, len(seq), length))
+        codes = np.frombuffer(seq, dtype=np.uint8)[np.newaxis, :]
+        if not is_packable(codes):
+            return None
+        seen.add(header)
+        ids.append(header)
+        packed.append(pack_sequences(codes)[0])
+    words = -(-(length or 0) // 64)
+    return PackedAlignment(ids, np.array(packed, dtype=np.uint64).reshape(len(ids), 4, words), length or 0)
+
+def encode_sequence(seq):
+    '''
+    this is a function to encode a sequence as an array of small integers
+    Arguments : seq (str) : aligned sequence, ASCII characters only
+    Returns : character codes of the sequence (numpy array of uint8)
+    '''
+    return np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+
+def encode_sequences(sequences):
+    '''
+    this is a function to encode a set of aligned sequences into one 2D array
+    Arguments : sequences (iterable of str) : aligned sequences of equal length
+    Returns : array with one encoded sequence per row (numpy array of uint8)
+    '''
+    encoded = [encode_sequence(seq) for seq in sequences]
+    if len({len(seq) for seq in encoded}) > 1:
+        raise ValueError('aligned sequences must all have the same length')
+    return np.array(encoded, dtype=np.uint8).reshape(len(encoded), -1)
+
+def build_lookup_tables(weights):
+    '''
+    this is a function to precompute the score and identity of every pair of characters,
+    following the same rules as score_alignment_identity
+    Arguments : weights (dict) : scores for reference
+    Returns : score and identity lookup tables indexed by [code_1, code_2] (tuple of 2D arrays)
+    '''
+    codes = np.arange(ALPHABET_SIZE)
+    base_1 = codes[:, np.newaxis]                     # character of the first sequence
+    base_2 = codes[np.newaxis, :]                     # character of the second sequence
+
+    def is_in(base, group):
+        return np.isin(base, [ord(char) for char in group])
+
+    same = base_1 == base_2
+    match = same & ~is_in(base_1, '-?')               # identical nucleotides, gaps excluded
+    transition = ~same & ((is_in(base_1, 'AG') & is_in(base_2, 'AG')) |
+                          (is_in(base_1, 'TC') & is_in(base_2, 'TC')))
+    gap = ~same & ~transition & (is_in(base_1, '-') | is_in(base_2, '-'))
+    unknown = ~same & ~transition & ~gap & (is_in(base_1, '?') | is_in(base_2, '?'))
+    transversion = ~same & ~transition & ~gap & ~unknown
+
+    score_table = (match * weights['match'] + transition * weights['transition'] +
+                   gap * weights['gap'] + transversion * weights['transversion'])
+    return score_table.astype(np.int32), match
+
+def packed_coefficients(weights):
+    '''
+    this is a function to gather the weights that score bit-packed sequences (see count_packed_block),
+    which stand in for the lookup tables of build_lookup_tables
+    Arguments : weights (dict) : scores for reference
+    Returns : match, transition, transversion and gap weights (tuple of int)
+    '''
+    return tuple(int(weights[name]) for name in ('match', 'transition', 'transversion', 'gap'))
+
+def _character_table(characters):
+    '''
+    this is a function to flag a set of characters in a table indexed by character code
+    '''
+    table = np.zeros(ALPHABET_SIZE, dtype=bool)
+    table[[ord(char) for char in characters]] = True
+    return table
+
+# bit planes of a packed sequence: pyrimidine, second base of its class (G or T),
+# nucleotide (not a gap nor unknown) and gap. Unknown nucleotides have no bit set
+PACKED_PLANES = [_character_table('CT'), _character_table('GT'), _character_table('ACGT'), _character_table('-')]
+PACKED_DECODE = np.frombuffer(b'????????????????', dtype=np.uint8).copy() # character of each plane combination
+PACKED_DECODE[[4, 5, 6, 7]] = [ord(char) for char in 'ACGT']
+PACKED_DECODE[8] = ord('-')
+POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+def is_packable(codes):
+    '''
+    this is a function to check that encoded sequences only hold PACKED_CHARACTERS
+    '''
+    return bool(_character_table(PACKED_CHARACTERS)[codes].all())
+
+def pack_sequences(codes):
+    '''
+    this is a function to pack encoded sequences into four bit planes of 64-bit words, so that
+    64 columns of a pair are compared with a few bitwise operations
+    Arguments : codes (2D array) : encoded aligned sequences of PACKED_CHARACTERS, one per row
+    Returns : bit planes of every sequence, indexed by [sequence, plane, word] (3D array of uint64)
+    '''
+    if not is_packable(codes):
+        raise ValueError('only sequences of {} can be bit-packed'.format(PACKED_CHARACTERS))
+    n_seqs, length = codes.shape
+    words = -(-length // 64)
+    packed = np.zeros((n_seqs, len(PACKED_PLANES), words), dtype=np.uint64)
+    rows = max(1, BLOCK_CELLS // max(1, length))        # rows packed per step to bound memory
+    for start in range(0, n_seqs, rows):
+        for plane, table in enumerate(PACKED_PLANES):
+            bits = np.zeros((len(codes[start:start + rows]), words * 8), dtype=np.uint8)
+            bits[:, :-(-length // 8)] = np.packbits(table[codes[start:start + rows]], axis=1, bitorder='little')
+            packed[start:start + rows, plane] = bits.view(np.uint64)
+    return packed
+
+def unpack_sequences(packed, length):
+    '''
+    this is a function to decode bit-packed sequences (see pack_sequences)
+    Arguments : packed (3D array) : bit planes of every sequence
+                length (int) : alignment length
+    Returns : encoded sequences, one per row (2D array of uint8)
+    '''
+    codes = np.zeros((len(packed), length), dtype=np.uint8)
+    for plane in range(len(PACKED_PLANES)):
+        bits = np.ascontiguousarray(packed[:, plane]).view(np.uint8)
+        codes |= np.unpackbits(bits, axis=1, count=length, bitorder='little') << plane
+    return PACKED_DECODE[codes]
+
+def popcount_rows(words):
+    '''
+    this is a function to count the bits set in every row of a 2D array of 64-bit words
+    '''
+    if hasattr(np, 'bitwise_count'):                  # numpy 2.0 and later
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+    return POPCOUNT_TABLE[np.ascontiguousarray(words).view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+def count_packed_block(packed_1, block, coefficients):
+    '''
+    this is a function to count identical nucleotides and sum alignment scores of one bit-packed
+    sequence against a block of bit-packed sequences, with the same rules as score_alignment_identity
+    Arguments : packed_1 (2D array) : bit planes of a sequence
+                block (3D array) : bit planes of sequences, one per row
+                coefficients (tuple) : weights from packed_coefficients
+    Returns : number of identical nucleotides and alignment scores per row (tuple of arrays)
+    '''
+    match, transition, transversion, gap = coefficients
+    pyrimidine_1, second_1, nucleotide_1, gap_1 = packed_1
+    identical = np.empty(len(block), dtype=np.int64)
+    score = np.empty(len(block), dtype=np.int64)
+    rows = max(1, BLOCK_CELLS // max(1, 64 * packed_1.shape[1]))  # rows scored per step to bound memory
+    for start in range(0, len(block), rows):
+        chunk = block[start:start + rows]
+        nucleotides = chunk[:, 2] & nucleotide_1      # columns where both sequences have a nucleotide
+        same_class = nucleotides & ~(chunk[:, 0] ^ pyrimidine_1)
+        other_base = chunk[:, 1] ^ second_1
+        matches = popcount_rows(same_class & ~other_base)
+        transitions = popcount_rows(same_class & other_base)
+        transversions = popcount_rows(nucleotides) - matches - transitions
+        gaps = popcount_rows(chunk[:, 3] ^ gap_1)      # gap against anything but a gap
+        identical[start:start + rows] = matches
+        score[start:start + rows] = (matches * match + transitions * transition +
+                                     transversions * transversion + gaps * gap)
+    return identical, score
+
+def count_block(codes_1, block, tables, counts=None):
+    '''
+    this is a function to count identical nucleotides and sum alignment scores of one
+    encoded sequence against a block of encoded sequences
+    Arguments : codes_1 (array) : encoded sequence
+                block (2D array) : encoded sequences, one per row
+                tables (tuple) : lookup tables from build_lookup_tables
+                counts (array) : number of alignment columns behind each column of compressed
+                                 sequences (see compress_alignment), or None when every column counts once
+    Returns : number of identical nucleotides and alignment scores per row (tuple of arrays)
+    '''
+    score_table, identity_table = tables
+    identical = np.empty(len(block), dtype=np.int64)
+    score = np.empty(len(block), dtype=np.int64)
+    rows = max(1, BLOCK_CELLS // max(1, len(codes_1)))  # rows scored per step to bound memory
+    for start in range(0, len(block), rows):
+        chunk = block[start:start + rows]
+        if counts is None:
+            identical[start:start + rows] = np.count_nonzero(identity_table[codes_1, chunk], axis=1)
+            score[start:start + rows] = score_table[codes_1, chunk].sum(axis=1, dtype=np.int64)
+        else:                                         # each column pattern weighs as many columns as it stands for
+            identical[start:start + rows] = identity_table[codes_1, chunk] @ counts
+            score[start:start + rows] = score_table[codes_1, chunk].astype(np.int64) @ counts
+    return identical, score
+
+def count_tile(rows, cols, tables, counts):
+    '''
+    this is a function to count identical nucleotides and sum alignment scores of every pair
+    of two blocks of compressed sequences (see compress_alignment). The columns are summed
+    once per character of the first block, as products of weighted indicator matrices
+    Arguments : rows, cols (2D arrays) : encoded sequences over the same column patterns, one per row
+                tables (tuple) : lookup tables from build_lookup_tables
+                counts (array) : number of alignment columns behind each column pattern
+    Returns : number of identical nucleotides and alignment scores of every pair (tuple of 2D arrays)
+    '''
+    score_table, identity_table = tables
+    # float64 products of integers are exact as long as the sums stay below 2**53
+    identical = np.zeros((len(rows), len(cols)), dtype=np.float64)
+    score = np.zeros((len(rows), len(cols)), dtype=np.float64)
+    step = max(1, BLOCK_CELLS // max(1, len(rows), len(cols)))  # columns summed per step to bound memory
+    for start in range(0, rows.shape[1], step):
+        row_chunk = rows[:, start:start + step]
+        col_chunk = cols[:, start:start + step]
+        weight = counts[start:start + step].astype(np.float64)
+        for code in np.flatnonzero(np.bincount(row_chunk.ravel(), minlength=ALPHABET_SIZE)):
+            weighted = (row_chunk == code) * weight   # columns where the first sequence has this character
+            if identity_table[code].any():
+                identical += weighted @ identity_table[code].astype(np.float64)[col_chunk].T
+            if score_table[code].any():
+                score += weighted @ score_table[code].astype(np.float64)[col_chunk].T
+    return np.rint(identical).astype(np.int64), np.rint(score).astype(np.int64)
+
+def identity_percent(identical, length):
+    '''
+    this is a function to convert identical nucleotide counts into identity scores,
+    rounded in the same way as score_alignment_identity
+    Arguments : identical (array) : number of identical nucleotides per pair
+                length (int) : alignment length
+    Returns : identity scores (numpy array of float)
+    '''
+    # only the distinct counts are rounded in Python, then mapped back to every pair
+    counts, inverse = np.unique(np.asarray(identical), return_inverse=True)
+    rounded = np.array([round(100 * count / length, 1) for count in counts.tolist()], dtype=np.float64)
+    return rounded[inverse].reshape(np.shape(identical))
+
+def score_block(codes_1, block, tables):
+    '''
+    this is a function to score one encoded sequence against a block of encoded sequences,
+    giving the same values as calling score_alignment_identity on every pair
+    Arguments : codes_1 (array) : encoded sequence
+                block (2D array) : encoded sequences of the same length, one per row
+                tables (tuple) : lookup tables from build_lookup_tables
+    Returns : identity and alignment scores per row (tuple of arrays)
+    '''
+    if block.shape[1] != len(codes_1):
+        raise ValueError('aligned sequences must all have the same length')
+    identical, score = count_block(codes_1, block, tables)
+    return identity_percent(identical, len(codes_1)), score
+
+def _distinct_rows(rows):
+    '''
+    this is a function to find the distinct rows of a 2D array, in order of first occurrence
+    Arguments : rows (2D array) : array to compress
+    Returns : first row with each content (array), position of every row among the distinct
+              ones (array) and number of rows with each content (array)
+    '''
+    index = {}                                         # position of each distinct row content
+    positions = np.fromiter((index.setdefault(row.tobytes(), len(index)) for row in rows),
+                            dtype=np.int64, count=len(rows))
+    first = np.zeros(len(index), dtype=np.int64)
+    first[positions[::-1]] = np.arange(len(rows) - 1, -1, -1)
+    return first, positions, np.bincount(positions, minlength=len(index)).astype(np.int64)
+
+def compress_alignment(codes):
+    '''
+    this is a function to compress an alignment by keeping every distinct sequence once, and
+    every distinct column pattern of those sequences once with the number of columns it stands for
+    Arguments : codes (2D array) : encoded aligned sequences, one per row
+    Returns : distinct sequences over the distinct column patterns (2D array), number of columns
+              of each pattern (array) and position of every sequence among the distinct ones (array)
+    '''
+    first, positions, _ = _distinct_rows(codes)
+    distinct = codes[first]
+    columns, _, counts = _distinct_rows(np.ascontiguousarray(distinct.T))
+    return np.ascontiguousarray(distinct[:, columns]), counts, positions
+
+def make_tiles(n_seqs, jobs):
+    '''
+    this is a function to split the upper triangle of all pairs into square tiles
+    Arguments : n_seqs (int) : number of sequences
+                jobs (int) : number of worker processes the tiles are shared among
+    Returns : tile size and list of tiles as (row_start, col_start), ordered by row then column (tuple)
+    '''
+    # several tiles per worker and per row block keep the workers evenly loaded
+    tile_size = max(1, min(MAX_TILE, -(-n_seqs // (4 * jobs))))
+    starts = range(0, n_seqs, tile_size)
+    return tile_size, [(row, col) for row in starts for col in starts if col >= row]
+
+_tile_codes = None  # encoded alignment shared with the worker processes
+_tile_tables = None # lookup tables shared with the worker processes
+_tile_counts = None # columns behind each column of compressed codes, shared with the worker processes
+_tile_bitpacked = False # the codes are bit planes and the tables the weights of packed_coefficients
+
+def _init_tile_worker(codes, tables, counts=None, bitpacked=False):
+    global _tile_codes, _tile_tables, _tile_counts, _tile_bitpacked
+    _tile_codes = codes
+    _tile_tables = tables
+    _tile_counts = counts
+    _tile_bitpacked = bitpacked
+
+def _count_tile_rows(codes_1, block):
+    '''
+    this is a function to score one sequence against a block of sequences with the engine the worker was set up for
+    '''
+    if _tile_bitpacked:
+        return count_packed_block(codes_1, block, _tile_tables)
+    return count_block(codes_1, block, _tile_tables, _tile_counts)
+
+def _bounded_imap(pool, function, tasks, jobs):
+    '''
+    this is a function to map tasks on a pool in order, as Pool.imap, but with at most
+    TASKS_PER_JOB tasks per worker submitted and not yet consumed, so that finished results
+    do not pile up when the caller is slower than the workers
+    Arguments : pool (Pool) : worker processes
+                function : function applied to every task
+                tasks (iterable) : arguments of the function
+                jobs (int) : number of worker processes
+    Returns : generator of the results in task order
+    '''
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= TASKS_PER_JOB * jobs:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _score_tile(tile):
+    '''
+    this is a function to score all pairs (i, j) with i < j inside one tile
+    Arguments : tile (tuple) : row start, column start and tile size
+    Returns : identical nucleotides and alignment scores of the tile (tuple of 2D arrays)
+    '''
+    row_start, col_start, tile_size = tile
+    rows = _tile_codes[row_start:row_start + tile_size]
+    cols = _tile_codes[col_start:col_start + tile_size]
+    if _tile_counts is not None:              # compressed tiles are scored whole, pairs with i >= j are ignored
+        return count_tile(rows, cols, _tile_tables, _tile_counts)
+    identical = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    score = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    for r in range(len(rows)):
+        first = max(0, row_start + r + 1 - col_start) # only pairs with i < j
+        if first < len(cols):
+            identical[r, first:], score[r, first:] = _count_tile_rows(rows[r], cols[first:])
+    return identical, score
+
+def score_all_pairs(codes, tables, jobs=1, counts=None):
+    '''
+    this is a function to score every pair of sequences (i, j) with i < j, optionally on
+    several processes
+    Arguments : codes (2D array) : encoded aligned sequences, one per row
+                tables (tuple) : lookup tables from build_lookup_tables
+                jobs (int) : number of worker processes
+                counts (array) : columns behind each column of compressed codes (see count_block), or None
+    Returns : generator of (i, identical, score) in row order, where identical and score hold
+              the number of identical nucleotides and the alignment scores against sequences i+1..n-1
+    '''
+    return _tiled_pairs(codes, tables, jobs, counts, False)
+
+def score_packed_pairs(packed, coefficients, jobs=1):
+    '''
+    this is a function to score every pair of bit-packed sequences (i, j) with i < j, optionally on
+    several processes
+    Arguments : packed (3D array) : bit planes of every sequence (see pack_sequences)
+                coefficients (tuple) : weights from packed_coefficients
+                jobs (int) : number of worker processes
+    Returns : generator of (i, identical, score) in row order, as score_all_pairs
+    '''
+    return _tiled_pairs(packed, coefficients, jobs, None, True)
+
+def _tiled_pairs(codes, tables, jobs, counts, bitpacked):
+    '''
+    this is a function to score every pair of sequences tile by tile, for score_all_pairs and score_packed_pairs
+    '''
+    n_seqs = len(codes)
+    tile_size, tiles = make_tiles(n_seqs, jobs)
+    tasks = ((row, col, tile_size) for row, col in tiles)
+    if jobs > 1:
+        pool = Pool(jobs, initializer=_init_tile_worker, initargs=(codes, tables, counts, bitpacked))
+        results = _bounded_imap(pool, _score_tile, tasks, jobs)  # results come back in tile order
+    else:
+        pool = None
+        _init_tile_worker(codes, tables, counts, bitpacked)
+        results = map(_score_tile, tasks)
+    try:
+        strip_row = None
+        for (row, col), (identical, score) in zip(tiles, results):
+            if row != strip_row:                  # a new row block starts
+                strip_row = row
+                strip_len = min(tile_size, n_seqs - row)
+                strip_identical = np.zeros((strip_len, n_seqs), dtype=np.int64)
+                strip_score = np.zeros((strip_len, n_seqs), dtype=np.int64)
+            strip_identical[:, col:col + tile_size] = identical
+            strip_score[:, col:col + tile_size] = score
+            if col + tile_size >= n_seqs:        # last tile of the row block
+                for r in range(strip_len):
+                    i = row + r
+                    yield i, strip_identical[r, i + 1:], strip_score[r, i + 1:]
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def compressed_pairs(codes, tables, jobs=1):
+    '''
+    this is a function to score every pair of sequences (i, j) with i < j over the compressed
+    alignment (see compress_alignment): only the pairs of distinct sequences are scored, over
+    the distinct column patterns, and their scores are repeated for every pair of sequence IDs
+    Arguments : codes (2D array) : encoded aligned sequences, one per row
+                tables (tuple) : lookup tables from build_lookup_tables
+                jobs (int) : number of worker processes
+    Returns : generator of (i, identical, score) in row order, as score_all_pairs
+    '''
+    patterns, counts, positions = compress_alignment(codes)
+    n_distinct = len(patterns)
+    # the rows of later sequences may need any pair of distinct sequences, which are all kept as int32 as in the pair cache
+    identical = np.zeros(n_distinct * (n_distinct - 1) // 2, dtype=np.int32)
+    score = np.zeros(n_distinct * (n_distinct - 1) // 2, dtype=np.int32)
+    for i, identical_row, score_row in score_all_pairs(patterns, tables, jobs, counts):
+        start = condensed_index(i, n_distinct)
+        identical[start:start + len(identical_row)] = _to_int32(identical_row)
+        score[start:start + len(score_row)] = _to_int32(score_row)
+    self_identical = np.zeros(n_distinct, dtype=np.int64)
+    self_score = np.zeros(n_distinct, dtype=np.int64)
+    for r in np.unique(positions[np.bincount(positions, minlength=n_distinct)[positions] > 1]):
+        self_identical[r], self_score[r] = (value[0] for value in count_block(patterns[r], patterns[r:r + 1], tables, counts))
+
+    for i in range(len(positions)):
+        first, others = positions[i], positions[i + 1:]
+        low, high = np.minimum(first, others), np.maximum(first, others)
+        same = others == first                         # duplicated sequences
+        index = condensed_index(low, n_distinct) + high - low - 1
+        index[same] = 0
+        identical_row = identical[index].astype(np.int64) if len(identical) else np.zeros(len(others), dtype=np.int64)
+        score_row = score[index].astype(np.int64) if len(score) else np.zeros(len(others), dtype=np.int64)
+        identical_row[same] = self_identical[first]
+        score_row[same] = self_score[first]
+        yield i, identical_row, score_row
+
+def read_weights(weights_file):
+    '''
+    this is a function to build a dictionary from the reference file with the weights
+    Arguments : weights_file : file with one weight type and value per line, separated by a tab
+    Returns : dictionary with weight types as keys, and weight values as values
+    '''
+    weights = {} # set up an empty dictionary to store weight type and value
+    with open(weights_file, 'r') as weight_file:
+        for line in weight_file:
+            line = line.split()
+            weights[line[0]] = int(line[1]) # add weight type and values to dictionary
+    return weights
+
+def _write_text_rows(output_file, ids, rows):
+    '''
+    this is a function to write rows of (i, identity, score) of pairs (i, j), with i < j,
+    as a tab separated text file
+    Returns : number of lines written (int)
+    '''
+    lines = 1
+    with open(output_file, 'w') as output:
+        output.write('SmpA\tSmpB\tId_s\tAl_s\n')                     # write out header row
+        for i, iden, score in rows:
+            for key_2, iden_pair, score_pair in zip(ids[i + 1:], iden.tolist(), score.tolist()):
+                output.write('{}\t{}\t{}%\t{}\n'.format(ids[i], key_2, iden_pair, score_pair)) # write out data
+            lines += len(score)
+    return lines
+
+def write_pairwise_text(output_file, ids, pairs, length):
+    '''
+    this is a function to write the pairwise scores as a tab separated text file
+    Arguments : output_file : path of the output file
+                ids (list) : sequence IDs in alignment order
+                pairs (iterator) : (i, identical, score) rows from score_all_pairs
+                length (int) : alignment length
+    Returns : number of lines written (int)
+    '''
+    return _write_text_rows(output_file, ids, ((i, identity_percent(identical, length), score)
+                                               for i, identical, score in pairs))
+
+def write_condensed_text(output_file, ids, identity, score):
+    '''
+    this is a function to write condensed pairwise scores (see collect_condensed) as the same
+    tab separated text file as write_pairwise_text
+    Arguments : output_file : path of the output file
+                ids (list) : sequence IDs in alignment order
+                identity, score (arrays) : condensed identity and alignment scores
+    Returns : number of lines written (int)
+    '''
+    n_seqs = len(ids)
 
-# how to build a dictionary from reference file
-with open(sys.argv[2], 'r') as weight_file:
-    for line in weight_file:
-        line = line.split()
-        weights[line[0]] = int(line[1]) # add weight type and values to dictionary
+    def rows():
+        for i in range(n_seqs - 1):
+            start, end = condensed_index(i, n_seqs), condensed_index(i + 1, n_seqs)
+            # float32 identities are rounded back to the one decimal they were written with
+            yield i, np.round(identity[start:end].astype(np.float64), 1), score[start:end]
+
+    return _write_text_rows(output_file, ids, rows())
+
+def condensed_index(i, n_seqs):
+    '''
+    this is a function to find where the pairs of sequence i with sequences i+1..n-1 start
+    in a condensed upper triangle (the pair order used by the text output and by scipy)
+    Arguments : i (int or array) : row of the first sequence
+                n_seqs (int) : number of sequences
+    Returns : position of pair (i, i+1) in the condensed arrays
+    '''
+    return i * n_seqs - i * (i + 1) // 2
+
+def collect_condensed(n_seqs, pairs, length):
+    '''
+    this is a function to gather the pairwise scores into condensed upper triangle arrays
+    Arguments : n_seqs (int) : number of sequences
+                pairs (iterator) : (i, identical, score) rows from score_all_pairs
+                length (int) : alignment length
+    Returns : condensed identity (float32) and alignment scores (int32) (tuple of arrays)
+    '''
+    identity = np.zeros(n_seqs * (n_seqs - 1) // 2, dtype=np.float32)
+    score = np.zeros(n_seqs * (n_seqs - 1) // 2, dtype=np.int32)
+    limits = np.iinfo(np.int32)
+    for i, identical, score_row in pairs:
+        if len(score_row) and (score_row.min() < limits.min or score_row.max() > limits.max):
+            raise ValueError('alignment scores do not fit in the binary pairwise format')
+        start = condensed_index(i, n_seqs)
+        identity[start:start + len(identical)] = identity_percent(identical, length)
+        score[start:start + len(score_row)] = score_row
+    return identity, score
+
+def write_pairwise_npz(output_file, ids, pairs, length):
+    '''
+    this is a function to write the pairwise scores as condensed upper triangle arrays in a
+    numpy .npz file, with keys ids, identity (float32) and score (int32)
+    Arguments : output_file : path of the output file
+                ids (list) : sequence IDs in alignment order
+                pairs (iterator) : (i, identical, score) rows from score_all_pairs
+                length (int) : alignment length
+    '''
+    identity, score = collect_condensed(len(ids), pairs, length)
+    save_pairwise(output_file, ids, identity, score)
+
+def save_pairwise(output_file, ids, identity, score):
+    '''
+    this is a function to save condensed pairwise scores in the binary pairwise format
+    Arguments : output_file : path of the output file
+                ids (list) : sequence IDs in alignment order
+                identity, score (arrays) : condensed identity and alignment scores
+    '''
+    with open(output_file, 'wb') as output:  # a file object keeps numpy from adding a suffix
+        np.savez(output, ids=np.array(ids, dtype=str), identity=identity, score=score)
+
+def load_pairwise(input_file):
+    '''
+    this is a function to load a file written by write_pairwise_npz
+    Arguments : input_file : path of the .npz file
+    Returns : sequence IDs (list), condensed identity and alignment scores (arrays)
+    '''
+    with np.load(input_file) as data:
+        if 'pair_i' in data.files:
+            raise ValueError('{} only holds the pairs of new sequences, see load_pairwise_delta'.format(input_file))
+        ids = data['ids'].tolist()
+        identity = data['identity']
+        score = data['score']
+    if len(identity) != len(ids) * (len(ids) - 1) // 2 or len(score) != len(identity):
+        raise ValueError('{} does not hold the pairs of {} sequences'.format(input_file, len(ids)))
+    return ids, identity, score
+
+def sequence_keys(codes):
+    '''
+    this is a function to hash the content of every encoded sequence
+    Arguments : codes (2D array) : encoded aligned sequences, one per row
+    Returns : hex digest of every sequence (list of str)
+    '''
+    return [hashlib.blake2b(row.tobytes(), digest_size=16).hexdigest() for row in codes]
+
+def packed_sequence_keys(packed, length):
+    '''
+    this is a function to hash the content of every bit-packed sequence, giving the same keys as sequence_keys
+    Arguments : packed (3D array) : bit planes of every sequence (see pack_sequences)
+                length (int) : alignment length
+    Returns : hex digest of every sequence (list of str)
+    '''
+    # decoded one at a time, so that the whole alignment is never held one byte per nucleotide
+    return [sequence_keys(unpack_sequences(row[np.newaxis], length))[0] for row in packed]
+
+def weights_key(weights):
+    '''
+    this is a function to hash the weight values, so that cached scores are only reused
+    with the weights they were computed with
+    Arguments : weights (dict) : scores for reference
+    Returns : hex digest of the weights (str)
+    '''
+    text = ';'.join('{}={}'.format(name, weights[name]) for name in sorted(weights))
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+def packed_index(i, j):
+    '''
+    this is a function to find pair (i, j), with i > j, in a lower triangle packed by row,
+    where the pairs of a new sequence are appended at the end
+    Arguments : i, j (int or arrays) : positions of the two sequences
+    Returns : position of the pair in the packed arrays
+    '''
+    return i * (i - 1) // 2 + j
+
+NPY_HEADER_SIZE = 128 # bytes of the header of the pair files, kept fixed so that they can grow in place
+
+def _npy_header(length):
+    '''
+    this is a function to write the header of a .npy file of length int32 values, padded to NPY_HEADER_SIZE
+    '''
+    text = "{{'descr': '<i4', 'fortran_order': False, 'shape': ({},), }}".format(length)
+    text = text.ljust(NPY_HEADER_SIZE - 11) + '\n'   # 10 bytes of magic, version and header length come first
+    return b'\x93NUMPY\x01\x00' + len(text).to_bytes(2, 'little') + text.encode('latin1')
+
+def _map_pairs(pairs_file, length, resize=False):
+    '''
+    this is a function to memory-map a .npy file of int32 pair values
+    Arguments : pairs_file : path of the .npy file
+                length (int) : number of values
+                resize (bool) : create, grow or shrink the file to length values, keeping the values
+                                it already holds; otherwise the file must hold at least length values
+    Returns : values of the file (memory-mapped array), or None when the file is too short
+    '''
+    if resize:
+        with open(pairs_file, 'r+b' if os.path.exists(pairs_file) else 'w+b') as pairs:
+            pairs.write(_npy_header(length))
+            pairs.truncate(NPY_HEADER_SIZE + 4 * length)  # new values are zeros until they are scored
+    elif not os.path.exists(pairs_file) or os.path.getsize(pairs_file) < NPY_HEADER_SIZE + 4 * length:
+        return None
+    if length == 0:                                     # empty files cannot be mapped
+        return np.zeros(0, dtype=np.int32)
+    return np.memmap(pairs_file, dtype='<i4', mode='r+', offset=NPY_HEADER_SIZE, shape=(length,))
+
+class PairCache:
+    '''
+    this is a class to keep the identical nucleotides and alignment scores of every pair of
+    distinct sequences between runs, keyed by a hash of the sequence content. The pairs are
+    int32 arrays memory-mapped from two .npy files next to the cache file, which grow in place
+    when sequences are added; the cache file itself only holds the small per-sequence arrays
+    Attributes : weights_key (str) : hash of the weights the scores were computed with
+                 keys (list) : hashes of the cached sequences
+                 identical, score (arrays) : pairs of cached sequences, lower triangle packed by row
+                 self_identical, self_score (arrays) : each cached sequence against itself
+                 ids (list) : sequence IDs of the last run
+                 id_keys (list) : hash of the sequence content of each ID of the last run
+                 cache_file : path of the cache file, or None to keep the pairs in memory
+    '''
+    def __init__(self, weights_key, keys=(), identical=None, score=None,
+                 self_identical=None, self_score=None, ids=(), id_keys=(), cache_file=None):
+        self.weights_key = weights_key
+        self.keys = list(keys)
+        empty = np.zeros(0, dtype=np.int32)
+        self.identical = empty if identical is None else identical
+        self.score = empty if score is None else score
+        self.self_identical = empty if self_identical is None else self_identical
+        self.self_score = empty if self_score is None else self_score
+        self.ids = list(ids)
+        self.id_keys = list(id_keys)
+        self.cache_file = cache_file
+
+    def pairs_files(self):
+        return self.cache_file + '.identical.npy', self.cache_file + '.score.npy'
+
+    @classmethod
+    def load(cls, cache_file, weights_key):
+        '''
+        this is a function to load a cache, which starts empty when the files do not exist,
+        are incomplete or were computed with other weights
+        '''
+        empty = cls(weights_key, cache_file=cache_file)
+        if not os.path.exists(cache_file):
+            return empty
+        with np.load(cache_file) as data:
+            if 'self_identical' not in data.files or str(data['weights_key']) != weights_key:
+                return empty
+            keys = data['keys'].tolist()
+            n_pairs = len(keys) * (len(keys) - 1) // 2
+            identical, score = (_map_pairs(pairs_file, n_pairs) for pairs_file in empty.pairs_files())
+            if identical is None or score is None:
+                return empty
+            # caches without the content of each ID count all of their IDs as new
+            id_keys = data['id_keys'].tolist() if 'id_keys' in data.files else ()
+            return cls(weights_key, keys, identical, score, data['self_identical'], data['self_score'],
+                       data['ids'].tolist(), id_keys, cache_file)
+
+    def compact(self, kept):
+        '''
+        this is a function to keep only some of the cached sequences, moving their pairs to the
+        start of the arrays in place
+        Arguments : kept (array) : increasing positions of the kept sequences
+        '''
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            os.remove(self.cache_file)      # a run stopped while the pairs move must not leave a valid-looking cache
+        for r in range(1, len(kept)):
+            # the pairs of row r come from a later or the same position, which is not overwritten yet
+            source = packed_index(kept[r], kept[:r])
+            self.identical[packed_index(r, 0):packed_index(r, r)] = self.identical[source]
+            self.score[packed_index(r, 0):packed_index(r, r)] = self.score[source]
+        self.keys = [self.keys[position] for position in kept]
+        self.self_identical = self.self_identical[kept]
+        self.self_score = self.self_score[kept]
+
+    def resize(self, n_seqs):
+        '''
+        this is a function to resize the pair arrays to the pairs of n_seqs sequences, keeping
+        the pairs of the first sequences
+        '''
+        n_pairs = n_seqs * (n_seqs - 1) // 2
+        if self.cache_file is None:
+            identical, score = np.zeros(n_pairs, dtype=np.int32), np.zeros(n_pairs, dtype=np.int32)
+            kept = min(n_pairs, len(self.identical))
+            identical[:kept], score[:kept] = self.identical[:kept], self.score[:kept]
+        else:
+            self.flush()
+            self.identical = self.score = None          # the old maps are closed before the files change size
+            identical, score = (_map_pairs(pairs_file, n_pairs, resize=True) for pairs_file in self.pairs_files())
+        self.identical, self.score = identical, score
+
+    def flush(self):
+        for values in (self.identical, self.score):
+            if isinstance(values, np.memmap):
+                values.flush()
+
+    def save(self):
+        '''
+        this is a function to write the cache file once the pair files are complete
+        '''
+        self.flush()
+        with open(self.cache_file + '.tmp', 'wb') as output:  # a file object keeps numpy from adding a suffix
+            np.savez(output, weights_key=self.weights_key, keys=np.array(self.keys, dtype=str),
+                     self_identical=self.self_identical, self_score=self.self_score,
+                     ids=np.array(self.ids, dtype=str), id_keys=np.array(self.id_keys, dtype=str))
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+
+def _score_cache_row(row):
+    '''
+    this is a function to score sequence row against all previous sequences of the tile codes
+    '''
+    return _count_tile_rows(_tile_codes[row], _tile_codes[:row])
+
+def _to_int32(values):
+    '''
+    this is a function to check that counts or scores fit in the int32 arrays of a pair cache
+    '''
+    limits = np.iinfo(np.int32)
+    if len(values) and (values.min() < limits.min or values.max() > limits.max):
+        raise ValueError('alignment scores do not fit in the pair cache')
+    return values.astype(np.int32)
+
+def update_cache(cache, ids, codes, tables, jobs=1, compress=False, bitpacked=False, length=None):
+    '''
+    this is a function to add the sequences of an alignment to a pair cache, scoring only
+    the pairs of sequences that are not cached yet. Cached sequences missing from the
+    alignment are dropped. The cache is updated in place: the pairs of the added sequences
+    are appended to the pair arrays, which only move when sequences are dropped
+    Arguments : cache (PairCache) : cache of the previous run
+                ids (list) : sequence IDs in alignment order
+                codes (2D array) : encoded aligned sequences, one per row
+                tables (tuple) : lookup tables from build_lookup_tables
+                jobs (int) : number of worker processes
+                compress (bool) : score the new pairs over the distinct column patterns (see compress_alignment)
+                bitpacked (bool) : codes are the bit planes of the sequences (see pack_sequences) and tables
+                                   the weights from packed_coefficients
+                length (int) : alignment length, needed for bit-packed codes
+    Returns : updated cache (PairCache) and position of every sequence in it (array)
+    '''
+    if compress and bitpacked:
+        raise ValueError('bit-packed sequences cannot be compressed, unpack them first')
+    keys = packed_sequence_keys(codes, length) if bitpacked else sequence_keys(codes)
+    first_row = {}                                     # first sequence with each content
+    for row, key in enumerate(keys):
+        first_row.setdefault(key, row)
+    old_position = {key: position for position, key in enumerate(cache.keys)}
+    kept = sorted((key for key in first_row if key in old_position), key=old_position.get)
+    added = [key for key in first_row if key not in old_position]
+    order = kept + added
+    n_kept, n_cached = len(kept), len(order)
+
+    old = np.array([old_position[key] for key in kept], dtype=np.int64)
+    if not np.array_equal(old, np.arange(len(cache.keys))):  # sequences were dropped: the kept pairs move up
+        cache.compact(old)
+    cache.resize(n_cached)
+
+    # only the pairs of the added sequences with all earlier ones are scored
+    cache_codes = codes[[first_row[key] for key in order]]
+    counts = None
+    if compress and added:    # the cached sequences are all distinct, only their columns are compressed
+        cache_codes, counts, _ = compress_alignment(cache_codes)
+    new_rows = range(n_kept, n_cached)
+    if jobs > 1 and len(added) > 1:
+        pool = Pool(jobs, initializer=_init_tile_worker, initargs=(cache_codes, tables, counts, bitpacked))
+        results = _bounded_imap(pool, _score_cache_row, new_rows, jobs)  # rows are written as they come back
+    else:
+        pool = None
+        _init_tile_worker(cache_codes, tables, counts, bitpacked)
+        results = map(_score_cache_row, new_rows)
+    try:
+        for r, (identical_row, score_row) in zip(new_rows, results):
+            cache.identical[packed_index(r, 0):packed_index(r, r)] = _to_int32(identical_row)
+            cache.score[packed_index(r, 0):packed_index(r, r)] = _to_int32(score_row)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    self_identical = np.zeros(n_cached, dtype=np.int32)
+    self_score = np.zeros(n_cached, dtype=np.int32)
+    self_identical[:n_kept] = cache.self_identical[:n_kept]
+    self_score[:n_kept] = cache.self_score[:n_kept]
+    for r in new_rows:
+        if bitpacked:
+            identical_self, score_self = count_packed_block(cache_codes[r], cache_codes[r:r + 1], tables)
+        else:
+            identical_self, score_self = count_block(cache_codes[r], cache_codes[r:r + 1], tables, counts)
+        self_identical[r], self_score[r] = _to_int32(identical_self)[0], _to_int32(score_self)[0]
+
+    position = {key: r for r, key in enumerate(order)}
+    positions = np.array([position[key] for key in keys], dtype=np.int64)
+    cache.keys, cache.self_identical, cache.self_score = order, self_identical, self_score
+    cache.ids, cache.id_keys = list(ids), keys
+    return cache, positions
+
+def cached_pairs(cache, positions):
+    '''
+    this is a function to read the scores of every pair of sequences (i, j), with i < j,
+    from a pair cache
+    Arguments : cache (PairCache) : cache holding all of the sequences
+                positions (array) : position of every sequence in the cache
+    Returns : generator of (i, identical, score) in row order, as score_all_pairs
+    '''
+    for i in range(len(positions)):
+        first, others = positions[i], positions[i + 1:]
+        same = others == first                         # duplicated sequences
+        index = packed_index(np.maximum(first, others), np.minimum(first, others))
+        index[same] = 0
+        # int64 rows as score_all_pairs, the cache keeps int32
+        identical = cache.identical[index].astype(np.int64) if len(cache.identical) else np.zeros(len(others), dtype=np.int64)
+        score = cache.score[index].astype(np.int64) if len(cache.score) else np.zeros(len(others), dtype=np.int64)
+        identical[same] = cache.self_identical[first]
+        score[same] = cache.self_score[first]
+        yield i, identical, score
+
+def write_pairwise_delta(output_file, ids, pairs, length, keys, base_keys):
+    '''
+    this is a function to write the pairs involving new sequences in a numpy .npz file, with
+    keys ids, pair_i, pair_j (positions in ids), identity (float32), score (int32), and the
+    content hashes id_keys and base_keys of every ID. The pairs of two sequences that are
+    not new are left out: they are only valid for matrices that hold these sequences with
+    the content of base_keys
+    Arguments : output_file : path of the output file
+                ids (list) : sequence IDs in alignment order
+                pairs (iterator) : (i, identical, score) rows from score_all_pairs or cached_pairs
+                length (int) : alignment length
+                keys (list) : hash of the sequence content of every ID (see sequence_keys)
+                base_keys (list) : hash of the content of every ID in the last run, '' for IDs it did not
+                                   have. IDs whose content changed since then are new
+    '''
+    is_new = np.array([key != base_key for key, base_key in zip(keys, base_keys)], dtype=bool)
+    pair_i, pair_j, identity, score = [], [], [], []
+    for i, identical, score_row in pairs:
+        keep = np.ones(len(score_row), dtype=bool) if is_new[i] else is_new[i + 1:]
+        columns = np.flatnonzero(keep)
+        pair_i.append(np.full(len(columns), i, dtype=np.int64))
+        pair_j.append(columns + i + 1)
+        identity.append(identity_percent(identical[columns], length).astype(np.float32))
+        score.append(score_row[columns].astype(np.int32))
+    with open(output_file, 'wb') as output:
+        np.savez(output, ids=np.array(ids, dtype=str),
+                 pair_i=np.concatenate(pair_i or [np.zeros(0, dtype=np.int64)]),
+                 pair_j=np.concatenate(pair_j or [np.zeros(0, dtype=np.int64)]),
+                 identity=np.concatenate(identity or [np.zeros(0, dtype=np.float32)]),
+                 score=np.concatenate(score or [np.zeros(0, dtype=np.int32)]),
+                 id_keys=np.array(keys, dtype=str), base_keys=np.array(base_keys, dtype=str))
+
+def load_pairwise_delta(input_file):
+    '''
+    this is a function to load a file written by write_pairwise_delta
+    Arguments : input_file : path of the .npz file
+    Returns : sequence IDs (list), positions of the pairs (arrays), identity and alignment scores (arrays),
+              content hashes and base content hashes of every ID (lists)
+    '''
+    with np.load(input_file) as data:
+        if 'base_keys' not in data.files:
+            raise ValueError('{} does not record the sequences it was computed against; '
+                             'write it again with this version of MSA.py'.format(input_file))
+        return (data['ids'].tolist(), data['pair_i'], data['pair_j'], data['identity'], data['score'],
+                data['id_keys'].tolist(), data['base_keys'].tolist())
+
+def is_npz(input_file):
+    '''
+    this is a function to check if a file is a numpy .npz archive by its content, whatever its extension
+    '''
+    with open(input_file, 'rb') as data:
+        return data.read(4) == b'PK\x03\x04'           # npz files are zip archives
+
+def is_pairwise_delta(input_file):
+    '''
+    this is a function to check if a file was written by write_pairwise_delta
+    '''
+    if not is_npz(input_file):
+        return False
+    with np.load(input_file) as data:
+        return 'pair_i' in data.files
+
+def pairwise_rows(alignment, weights, jobs=1, cache_file=None, delta_file=None, compress=False):
+    '''
+    this is a function to score every pair of sequences of an alignment, optionally through
+    a pair cache that is updated on disk
+    Arguments : alignment (EncodedAlignment or PackedAlignment) : aligned sequences, scored bit-packed
+                                                                  when they are packed and not compressed
+                weights (dict) : scores for reference
+                jobs (int) : number of worker processes
+                cache_file : pair cache file (see PairCache), or None to score every pair
+                delta_file : output file for the pairs of sequences new or changed since the last run
+                             with the same cache (see write_pairwise_delta), or None
+                compress (bool) : score only distinct sequences over distinct column patterns
+                                  (see compress_alignment), giving the same scores
+    Returns : generator of (i, identical, score) in row order, as score_all_pairs
+    '''
+    bitpacked = isinstance(alignment, PackedAlignment)
+    if bitpacked and compress:
+        alignment, bitpacked = alignment.unpack(), False    # columns are compressed on the encoded sequences
+    if bitpacked:   # bit-packed sequences are scored straight from the weights, and never unpacked whole
+        codes, tables = alignment.packed, packed_coefficients(weights)
+    else:
+        codes, tables = alignment.codes, build_lookup_tables(weights) # score and identity of every pair of characters
+    if cache_file is None and compress:
+        return compressed_pairs(codes, tables, jobs)
+    if cache_file is None and bitpacked:
+        return score_packed_pairs(codes, tables, jobs)
+    if cache_file is None:
+        return score_all_pairs(codes, tables, jobs) # score every sequence against all later sequences
+    # score only the pairs missing from the cache
+    cache = PairCache.load(cache_file, weights_key(weights))
+    previous_keys = dict(zip(cache.ids, cache.id_keys))
+    cache, positions = update_cache(cache, alignment.ids, codes, tables, jobs, compress, bitpacked, alignment.length)
+    cache.save()
+    if delta_file:
+        # IDs are new when they were not in the last run, or when their sequence changed since
+        base_keys = [previous_keys.get(seq_id, '') for seq_id in alignment.ids]
+        write_pairwise_delta(delta_file, alignment.ids, cached_pairs(cache, positions), alignment.length,
+                             cache.id_keys, base_keys)
+    return cached_pairs(cache, positions)
+
+def write_pairwise(output_file, ids, pairs, length, output_format=None):
+    '''
+    this is a function to write the pairwise scores as text or as binary condensed arrays
+    Arguments : output_file : path of the output file
+                ids (list) : sequence IDs in alignment order
+                pairs (iterator) : (i, identical, score) rows from score_all_pairs
+                length (int) : alignment length
+                output_format (str) : text or npz. Defaults to npz for .npz files, text otherwise
+    Returns : number of text lines written, 0 for npz files (int)
+    '''
+    if output_format == 'npz' or (output_format is None and output_file.endswith('.npz')):
+        write_pairwise_npz(output_file, ids, pairs, length)
+        return 0
+    return write_pairwise_text(output_file, ids, pairs, length)
+
+def main(argv=None):
+    '''
+    this is a function to run the script with command line arguments
+    Arguments : argv (list) : arguments, defaults to sys.argv[1:]
+    '''
+    # The list of arguments is added (input fasta, weights and output file)
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('fasta_file', help = 'fasta file with aligned sequences')
+    p.add_argument('weights_file', help = 'file with weights used for alignment scoring')
+    p.add_argument('output_file', help = 'output file for the pairwise scores')
+    # Argument for the number of worker processes. Defaults to 1
+    p.add_argument('-j', '--jobs', dest = 'jobs', type = int, default = 1,
+                   help = 'number of worker processes. Default is 1')
+    # Argument for the format of the output file. Defaults to npz for .npz files, text otherwise
+    p.add_argument('-f', '--format', dest = 'format', choices = ['text', 'npz'],
+                   help = 'output format: text or binary npz. Default depends on the output file extension')
+    # Argument to memory-map the fasta file instead of reading it through a buffer
+    p.add_argument('--mmap', dest = 'mmap', action = 'store_true',
+                   help = 'memory-map the fasta file')
+    # Arguments for the pair cache kept between runs, and for the pairs of the new sequences
+    p.add_argument('--cache', dest = 'cache',
+                   help = 'pair cache file, created if it does not exist; only new pairs are scored')
+    p.add_argument('--delta', dest = 'delta',
+                   help = 'output file (.npz) for the pairs of sequences new or changed since the last run, requires --cache')
+    # Arguments to score only distinct sequences over distinct column patterns, or bit-packed sequences
+    engine = p.add_mutually_exclusive_group()
+    engine.add_argument('-z', '--compress', dest = 'compress', action = 'store_true',
+                        help = 'compress identical sequences and alignment columns before scoring')
+    engine.add_argument('-b', '--bitpacked', dest = 'bitpacked', action = 'store_true',
+                        help = 'hold and score the sequences bit-packed when they only have ' + PACKED_CHARACTERS)
+    # Arguments for the metrics of every stage and the progress of the pairwise scoring
+    p.add_argument('--metrics', dest = 'metrics', help = 'append the metrics of every stage to this file as JSON lines')
+    p.add_argument('--progress', dest = 'progress', action = 'store_true',
+                   help = 'print the progress of the pairwise scoring to stderr')
+    args = p.parse_args(argv)
+    Metrics.configure(args.metrics, args.progress)
+    if args.jobs < 1:
+        p.error('the number of jobs must be at least 1')
+    if args.delta and not args.cache:
+        p.error('--delta requires --cache')
 
-fasta_dict = fasta_to_dict(sys.argv[1]) # convert fasta to dictionary using function
+    weights = read_weights(args.weights_file)
+    with Metrics.stage('read_alignment') as counters:
+        alignment = read_packed_alignment(args.fasta_file, args.mmap) if args.bitpacked else None
+        if alignment is None:   # other characters are scored through the lookup tables
+            alignment = read_alignment(args.fasta_file, args.mmap) # read and encode every sequence once
+        counters.update(sequences=len(alignment), columns=alignment.length,
+                        bitpacked=isinstance(alignment, PackedAlignment))
+    with Metrics.stage('pairwise') as counters:
+        n_pairs = len(alignment) * (len(alignment) - 1) // 2
+        pairs = pairwise_rows(alignment, weights, args.jobs, args.cache, args.delta, args.compress)
+        pairs = Metrics.track(pairs, n_pairs, 'pairwise', lambda row: len(row[2]))
+        lines = write_pairwise(args.output_file, alignment.ids, pairs, alignment.length, args.format)
+        counters.update(pairs=n_pairs, lines_written=lines, jobs=args.jobs)
+    print('DONE')
 
-with open(sys.argv[3], 'w') as output_file:
-    output_file.write('SmpA\tSmpB\tId_s\tAl_s\n')               # write out header row
-    for i, (key_1, seq_1) in enumerate(fasta_dict.items()):     # get ID and seq from dictionary
-        for j, (key_2, seq_2) in enumerate(fasta_dict.items()): # get ID and seq from dictionary
-            if i < j:                                           # compare two non-repeating sequences
-                iden, score_seq = score_alignment_identity(seq_1, seq_2, weights) # get identity and alignment scores
-                output_file.write('{}\t{}\t{}%\t{}\n'.format(key_1, key_2, iden, score_seq)) # write out data
-print('DONE')
+if __name__ == '__main__':
+    main()
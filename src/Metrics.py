@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+'''
+Metrics.py
+Date: 2026-10-18
+Description: Module to measure the stages of the analysis run by MSA.py,
+SimilarityMatrix.py, Dendrogram.py and Pipeline.py. Every stage records its wall
+and CPU seconds, the peak resident memory of the process and its own counters
+(sequences parsed, pairs scored, lines written...), and is appended to a metrics
+file as one JSON line. The progress of the long pairwise phase, with an estimate
+of the remaining time, can also be printed to stderr. Both are off until
+configure is called, and then each stage only costs a few function calls.
+Usage:
+    import Metrics
+    Metrics.configure('metrics.jsonl', progress = True)
+    with Metrics.stage('fasta_to_dict') as counters:
+        counters['sequences'] = 16
+Records: one JSON object per line, with the keys stage, pid, wall_seconds,
+    cpu_seconds, children_cpu_seconds (worker processes that have exited),
+    peak_rss_kib, children_peak_rss_kib (largest worker process that has exited
+    so far, such as the workers of --jobs), the labels given to set_labels and the
+    counters of the stage.
+'''
+
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+try:
+    import resource     # peak memory, not available on Windows
+except ImportError:
+    resource = None
+
+PROGRESS_INTERVAL = 2.0 # seconds between two progress lines
+
+_metrics_file = None    # file the records are appended to, '-' for stderr, None when off
+_progress = False       # print the progress of long loops to stderr
+_labels = {}            # keys added to every record, such as the name of the dataset
+
+def configure(metrics_file = None, progress = False):
+    '''
+    Function to turn the metrics and the progress reports on or off.
+    Arguments:
+        metrics_file: File the records are appended to, '-' for stderr, or None for no records.
+        progress: Print the progress of long loops to stderr.
+    '''
+    global _metrics_file, _progress
+    _metrics_file = metrics_file
+    _progress = progress
+
+def set_labels(**labels):
+    '''
+    Function to set the keys added to every following record, such as dataset = name.
+    '''
+    global _labels
+    _labels = labels
+
+def peak_rss_kib(children = False):
+    '''
+    Function to find the peak resident memory of the process in KiB, or None when
+    the platform does not report it.
+    Arguments:
+        children: Peak of the largest child process that has exited and been waited
+                  for, instead of the process itself.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak   # bytes on macOS, KiB elsewhere
+
+def write_record(record):
+    '''
+    Function to append one record to the metrics file as a JSON line.
+    '''
+    line = json.dumps(record) + '\n'
+    if _metrics_file == '-':
+        sys.stderr.write(line)
+    else:
+        with open(_metrics_file, 'a') as output:   # one write per line keeps the lines of several processes whole
+            output.write(line)
+
+@contextmanager
+def stage(name):
+    '''
+    Function to measure one stage of the analysis, used as a context manager.
+    Nothing is measured nor written when the metrics are off.
+    Arguments:
+        name: Name of the stage.
+    Returns:
+        counters: Dictionary the stage fills with its counters.
+    '''
+    counters = {}
+    if _metrics_file is None:
+        yield counters
+        return
+    start_wall, start_times = time.perf_counter(), os.times()
+    yield counters
+    end_wall, end_times = time.perf_counter(), os.times()
+    record = {'stage': name, 'pid': os.getpid(),
+              'wall_seconds': round(end_wall - start_wall, 6),
+              # clock ticks can make an empty difference round to -0.0
+              'cpu_seconds': max(0.0, round(end_times.user + end_times.system
+                                            - start_times.user - start_times.system, 6)),
+              'children_cpu_seconds': max(0.0, round(end_times.children_user + end_times.children_system
+                                                     - start_times.children_user - start_times.children_system, 6)),
+              'peak_rss_kib': peak_rss_kib(),
+              'children_peak_rss_kib': peak_rss_kib(children = True)}
+    record.update(_labels)
+    record.update(counters)
+    write_record(record)
+
+def track(items, total, name, size = None):
+    '''
+    Function to report the progress of a loop over items to stderr, with an estimate
+    of the remaining time. The items are returned untouched when progress is off.
+    Arguments:
+        items: Iterable of the loop.
+        total: Amount of work of the whole loop.
+        name: Name of the loop in the progress lines.
+        size: Function giving the amount of work of an item. Defaults to 1 per item.
+    Returns:
+        items: Generator of the same items.
+    '''
+    if not _progress:
+        return items
+    return _track(items, total, name, size)
+
+def _track(items, total, name, size):
+    '''
+    Function to yield the items of track while printing the progress lines.
+    '''
+    start = last = time.perf_counter()
+    done = 0
+    shown = None    # amount of work of the last progress line
+    for item in items:
+        yield item
+        done += 1 if size is None else size(item)
+        now = time.perf_counter()
+        if done != shown and (now - last >= PROGRESS_INTERVAL or done >= total):
+            last, shown = now, done
+            elapsed = now - start
+            remaining = elapsed * (total - done) / done if done else 0.0
+            sys.stderr.write('{}: {}/{} ({:.1f}%), {:.1f} s elapsed, ETA {:.1f} s\n'.format(
+                name, done, total, 100 * done / total if total else 100.0, elapsed, remaining))
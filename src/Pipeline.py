@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+'''
+Pipeline.py
+Date: 2026-10-18
+Description: Script to run the whole analysis in one process per dataset: pairwise
+identity and alignment scores (MSA.py), identity and normalized score matrices
+(SimilarityMatrix.py) and hierarchical clustering (Dendrogram.py). Every step
+passes its results to the next one in memory, and independent datasets are
+processed concurrently. Intermediate files are only written when a results
+directory is given, with the same names and contents as executable.sh used to
+write them.
+Usage: Pipeline.py [-h] -w weights_file [-j jobs] [-p processes] [-r results_dir]
+        [-c cache_dir] [-z | -b] [-t title] [-t title ...] [-m method] [-d] [-l]
+        [-f figure_file] [-s suptitle] [--max-leaves max_leaves]
+        [--metrics metrics_file] [--progress]
+        name=fasta_file [name=fasta_file ...]
+Example: python3 Pipeline.py -w ../data/weights.txt -r ../results -t 'Y Chromosome' -t mtDNA
+            Ychr=../data/y_chromosome_orig.fasta mtdna=../data/mtdna_orig.fasta
+Arguments:
+    - name=fasta_file: Name of a dataset and its fasta file with aligned sequences.
+    - -w weights_file: File with the weights used for alignment scoring.
+    - [-j jobs]: Number of worker processes scoring the pairs of each dataset. Defaults to 1
+    - [-p processes]: Number of datasets processed at the same time. Defaults to all of them
+    - [-r results_dir]: Directory for the intermediate files: MSA<name>.txt,
+                        output_id_<name>.txt and output_score_<name>.txt (name in
+                        lower case), and the Newick trees and linkage arrays of the matrices.
+    - [-c cache_dir]: Directory with one pair cache per dataset (see MSA.py --cache).
+    - [-z]: Compress identical sequences and alignment columns before scoring (see MSA.py --compress).
+    - [-b]: Hold and score the sequences bit-packed (see MSA.py --bitpacked).
+    - [-t title]: Title of a dataset in the figure, given once per dataset in the same
+                  order. Defaults to the dataset names.
+    - [-m method], [-d], [-l]: Clustering options, as in Dendrogram.py.
+    - [-f figure_file]: Save the figure to this file instead of showing it.
+    - [-s suptitle]: Title of the figure.
+    - [--max-leaves max_leaves]: Largest number of leaves drawn in a dendrogram. Defaults to 200
+    - [--metrics metrics_file]: Append the time, memory and counters of every stage to this
+                                file as JSON lines ('-' for stderr), labelled with the dataset name.
+    - [--progress]: Print the progress of the pairwise scoring of every dataset to stderr.
+'''
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import MSA
+import SimilarityMatrix as sm
+import Dendrogram
+import Metrics
+
+def run_dataset(name, fasta_file, weights, jobs = 1, results_dir = None, cache_dir = None,
+                compress = False, bitpacked = False, cluster_method = 'single', distance = False, low_memory = False):
+    '''
+    Function to run all steps of the analysis of one dataset in memory.
+    Arguments:
+        name: Name of the dataset, used for the intermediate files.
+        fasta_file: Fasta file with aligned sequences.
+        weights: Dictionary with the weights used for alignment scoring.
+        jobs: Number of worker processes scoring the pairs.
+        results_dir: Directory for the intermediate files, or None to write none.
+        cache_dir: Directory for the pair cache of the dataset, or None.
+        compress: Score only distinct sequences over distinct column patterns.
+        bitpacked: Hold and score the sequences bit-packed when they only have MSA.PACKED_CHARACTERS.
+        cluster_method, distance, low_memory: Clustering options (see Dendrogram.cluster_matrix).
+    Returns:
+        results: List of (clusters, labels) for the identity and the score matrices.
+    '''
+    Metrics.set_labels(dataset = name)
+    with Metrics.stage('read_alignment') as counters:
+        alignment = MSA.read_packed_alignment(fasta_file) if bitpacked else None
+        if alignment is None:
+            alignment = MSA.read_alignment(fasta_file)
+        counters.update(sequences = len(alignment), columns = alignment.length,
+                        bitpacked = isinstance(alignment, MSA.PackedAlignment))
+    with Metrics.stage('pairwise') as counters:
+        n_pairs = len(alignment) * (len(alignment) - 1) // 2
+        cache_file = os.path.join(cache_dir, '{}.cache.npz'.format(name)) if cache_dir else None
+        pairs = MSA.pairwise_rows(alignment, weights, jobs, cache_file, compress = compress)
+        pairs = Metrics.track(pairs, n_pairs, 'pairwise {}'.format(name), lambda row: len(row[2]))
+        identity, score = MSA.collect_condensed(len(alignment), pairs, alignment.length)
+        counters.update(pairs = n_pairs, jobs = jobs)
+    if results_dir:
+        with Metrics.stage('write_pairwise') as counters:
+            counters['lines_written'] = MSA.write_condensed_text(
+                os.path.join(results_dir, 'MSA{}.txt'.format(name)), alignment.ids, identity, score)
+    identity_matrix, score_matrix = sm.build_matrices(alignment.ids, identity, score)
+    del identity, score     # the matrices hold all of the pairs from here on
+
+    results = []
+    for kind, matrix in (('id', identity_matrix), ('score', score_matrix)):
+        Metrics.set_labels(dataset = name, matrix = kind)
+        prefix = os.path.join(results_dir, 'output_{}_{}'.format(kind, name.lower())) if results_dir else None
+        if prefix:
+            sm.make_matrix_file(matrix, prefix + '.txt')
+        # float64 values with the one decimal of the matrix files, so the linkage is the same as Dendrogram.py on them
+        clusters = Dendrogram.cluster_matrix(np.round(matrix.values.astype(np.float64), 1), cluster_method, distance, low_memory)
+        if prefix:
+            Dendrogram.save_clusters(clusters, matrix.labels, prefix)
+        results.append((clusters, matrix.labels))
+    return results
+
+def _parse_dataset(text):
+    '''
+    Function to split a name=fasta_file argument.
+    '''
+    name, separator, fasta_file = text.partition('=')
+    if not separator or not name or not fasta_file:
+        raise argparse.ArgumentTypeError('datasets are given as name=fasta_file, not {}'.format(text))
+    return name, fasta_file
+
+def main(argv = None):
+    '''
+    Function to run the script with command line arguments.
+    Arguments:
+        argv: List of arguments, defaults to sys.argv[1:].
+    '''
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('datasets', nargs = '+', type = _parse_dataset, metavar = 'name=fasta_file',
+                   help = 'name of a dataset and its fasta file')
+    p.add_argument('-w', dest = 'weights_file', required = True, help = 'file with the weights')
+    p.add_argument('-j', dest = 'jobs', type = int, default = 1,
+                   help = 'worker processes scoring the pairs of each dataset. Default is 1')
+    p.add_argument('-p', dest = 'processes', type = int,
+                   help = 'datasets processed at the same time. Default is all of them')
+    p.add_argument('-r', dest = 'results_dir', help = 'directory for the intermediate files')
+    p.add_argument('-c', dest = 'cache_dir', help = 'directory for the pair caches')
+    engine = p.add_mutually_exclusive_group()
+    engine.add_argument('-z', dest = 'compress', action = 'store_true',
+                        help = 'compress identical sequences and alignment columns before scoring')
+    engine.add_argument('-b', dest = 'bitpacked', action = 'store_true',
+                        help = 'hold and score the sequences bit-packed')
+    p.add_argument('-t', dest = 'titles', action = 'append',
+                   help = 'title of a dataset, given once per dataset in the same order')
+    p.add_argument('-m', dest = 'method', default = 'single',
+                   choices = ['single', 'average', 'weighted', 'centroid', 'median', 'ward'],
+                   help = 'method to use for clustering. Default is single')
+    p.add_argument('-d', dest = 'distance', action = 'store_true',
+                   help = 'cluster on the condensed distances 100 - similarity')
+    p.add_argument('-l', dest = 'low_memory', action = 'store_true',
+                   help = 'memory-efficient linkage for single and average methods')
+    p.add_argument('-f', dest = 'figure_file', help = 'save the figure to this file')
+    p.add_argument('-s', dest = 'suptitle',
+                   default = 'Hierarchical clustering dendograms for Y chromosome and mtDNA sequences',
+                   help = 'title of the figure')
+    p.add_argument('--max-leaves', dest = 'max_leaves', type = int, default = 200,
+                   help = 'largest number of leaves drawn in a dendrogram. Default is 200')
+    p.add_argument('--metrics', dest = 'metrics', help = 'append the metrics of every stage to this file as JSON lines')
+    p.add_argument('--progress', dest = 'progress', action = 'store_true',
+                   help = 'print the progress of the pairwise scoring to stderr')
+    args = p.parse_args(argv)
+    Metrics.configure(args.metrics, args.progress)
+    titles = args.titles or [name for name, fasta_file in args.datasets]
+    if len(titles) != len(args.datasets):
+        p.error('one title is needed per dataset')
+    if args.low_memory and args.method not in Dendrogram.LOW_MEMORY_METHODS:
+        p.error('-l only supports the methods ' + ', '.join(Dendrogram.LOW_MEMORY_METHODS))
+    if args.jobs < 1 or (args.processes is not None and args.processes < 1):
+        p.error('the number of jobs and processes must be at least 1')
+    for directory in (args.results_dir, args.cache_dir):
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+
+    weights = MSA.read_weights(args.weights_file)
+    options = (weights, args.jobs, args.results_dir, args.cache_dir, args.compress, args.bitpacked, args.method, args.distance, args.low_memory)
+    processes = min(args.processes or len(args.datasets), len(args.datasets))
+    if processes > 1:   # independent datasets run in their own processes
+        # the workers get the metrics settings whatever the way they are started
+        with ProcessPoolExecutor(processes, initializer = Metrics.configure,
+                                 initargs = (args.metrics, args.progress)) as executor:
+            futures = [executor.submit(run_dataset, name, fasta_file, *options) for name, fasta_file in args.datasets]
+            dataset_results = [future.result() for future in futures]
+    else:
+        dataset_results = [run_dataset(name, fasta_file, *options) for name, fasta_file in args.datasets]
+
+    results = []
+    plot_titles = []
+    for title, (identity_result, score_result) in zip(titles, dataset_results):
+        results.extend([identity_result, score_result])
+        plot_titles.extend(['{} identity'.format(title), '{} score'.format(title)])
+    Dendrogram.plot_dendrograms(results, plot_titles, args.suptitle, args.max_leaves, args.figure_file)
+    print('DONE')
+
+if __name__ == '__main__':
+    main()
@@ -8,15 +8,27 @@ Authors: Pinar Oncel, Mara Vizitiu, Julio Ayala
 
 Description: Using an input file consisting of scores of pairwise sequence alignments between multiple DNA sequences, the script builds two similarity matrices, one based on the percentage identity and the other one on the normalized values of the pairwise alignment scores. For the purpose of the exercise, the script will be used twice, once for the alignment of the mtDNA, and once for the alignment of the Y chromosome sequences.
 
-List of user defined functions:
-    msa_to_dict - converts the data stored into the multiple sequence alignment scores file into a nested dictionary containing all of the names of the sequences being compared and their scores in respect to all of the other sequences.
+List of user defined classes and functions:
+    LabelledMatrix - square similarity matrix backed by a numpy array, with rows and columns in sorted sequence ID order
+    read_pairs, fill_text - read the pairwise scores of a text file written by MSA.py in chunks, straight into the matrices
+    fill_pairs, fill_condensed - fill the identity and raw score matrices from the pairwise scores in one pass
+    normalize_scores - normalizes the raw score matrix in a single vectorized operation
+    read_matrices - reads the identity and raw score matrices of the input file
+    update_matrices - adds the pairs of new sequences to existing identity and raw score matrices
+    save_state, load_state - keep the identity and raw score matrices between runs
+    build_matrices - builds the identity and normalized score matrices from pairwise scores held in memory
+    msa_to_dict - converts the data stored into the multiple sequence alignment scores file (text or binary .npz) into the identity and normalized score matrices.
     make_matrix_file - prints the data as a similarity matrix into the output file
     get_most_similar - finds the most similar (highest score) sequence to a specified sequence and returns both the name of the found sequence, as well as the alignment score
+    NeighbourIndex - precomputed top-k most similar sequences of every sequence, which can be saved to and loaded from a .npz file
 
-List of modules used that are not explained in the course material: N/A
+List of modules used that are not explained in the course material:
+    numpy - stores the matrices as arrays of float32
+    MSA - loads the binary pairwise format written by MSA.py
+    Metrics - measures the time, memory and counters of every stage when --metrics is given
 
 Procedure:
-    1. Define a function that converts the data in the input file (i. e. scores and percentages of identity of pairwise sequence alignments) into similarity matrices in the form of nested dictionaries.
+    1. Define a function that converts the data in the input file (i. e. scores and percentages of identity of pairwise sequence alignments) into similarity matrices stored as numpy arrays.
     2. Inside the same function, normalize the alignment scores for an easier interpretation of the results.
     3. Define a function that prints the resulting matrices to separate output files (for normalized score and percentage of identity), in the desired format.
     4. Call the above mentioned functions to create the matrices using the proper input files and build corresponding output files.
@@ -25,74 +37,331 @@ Usage: python SimilarityMatrix.py MSAmtdna.txt output_id_mtdna.txt output_score_
         #For the mitochondrial DNA alignment file
        python SimilarityMatrix.py MSAYchr.txt output_id_ychr.txt output_score_ychr.txt
         #For the Y chromosome alignment file
+       python SimilarityMatrix.py MSAmtdna.npz output_id_mtdna.txt output_score_mtdna.txt
+        #For a binary pairwise file written by MSA.py
+       python SimilarityMatrix.py MSAmtdna.txt output_id_mtdna.txt output_score_mtdna.txt -n neighbours_mtdna.npz -k 5
+        #Also save the 5 most similar sequences of every sequence, by identity
+       python SimilarityMatrix.py delta_mtdna.npz output_id_mtdna.txt output_score_mtdna.txt -u state_mtdna.npz
+        #Update the matrices kept in state_mtdna.npz with the new pairs written by MSA.py --cache --delta
 
-Arguments: sys.argv[0] - script file
-           sys.argv[1] - input file
-           sys.argv[2] - output file 1 (Identity)
-           sys.argv[3] - output file 2 (Score)
+Arguments: input_file - input file (text, or binary .npz from MSA.py, recognized by its content)
+           output_id - output file 1 (Identity)
+           output_score - output file 2 (Score)
+           [-n neighbour_file] - output file for the neighbour index (.npz), used by SimilarityMatrixPt2.py
+           [-k number] - number of most similar sequences kept per sequence in the neighbour index. Default is 1
+           [-m metric] - matrix used for the neighbour index: identity or score. Default is identity
+           [-u state_file] - file (.npz) keeping the identity and raw score matrices between runs. When the input
+                             file is a delta written by MSA.py, only its pairs are added to the kept matrices. Every
+                             delta of the cache must be applied in turn: a delta computed against other sequences
+                             than the kept ones is rejected
+           [--metrics metrics_file] - file the metrics of every stage are appended to as JSON lines ('-' for stderr)
 
 '''
 
-import sys
+import os
+import argparse
+from itertools import islice
+import numpy as np
+import MSA
+import Metrics
 
-def msa_to_dict(input_file):    #Function that stores data from the input file into a nested dictionary
-    msa_matrix_identity = {}    #Matrix (dictionary of dictionaries) of identity percentages
-    msa_matrix_score = {}       #Matrix (dictionary of dictionaries) of alignment scores
-    list_of_scores = []         #List of all the alignment scores
+PAIR_CHUNK = 1 << 14   #Lines of a text file parsed at once, so that the pairs never all exist as Python objects
+DECIMAL_TEXT = [str(tenths / 10) for tenths in range(1001)] #Text of every value from 0.0 to 100.0 with one decimal, as written by str(round(value, 1))
+
+class LabelledMatrix:   #Square matrix backed by a numpy array, with rows and columns in sorted sequence ID order
+    def __init__(self, labels, values, order=None):
+        self.labels = labels                    #Sorted sequence IDs, one per row and column
+        self.index = {label: i for i, label in enumerate(labels)}   #Row of each sequence ID
+        self.values = values                    #numpy array with the values of the matrix
+        self.order = list(labels) if order is None else order      #Sequence IDs in the order they appear in the input file
+        self.rank = np.empty(len(labels), dtype=np.int64)   #Position of each row in self.order, used to break ties
+        self.rank[[self.index[label] for label in self.order]] = np.arange(len(self.order))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):                         #Iterate through the IDs in input file order
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def row(self, name):                        #Values of one sequence against all of the sorted IDs
+        return self.values[self.index[name]]
+
+def _text_ids(input_file):      #Function that finds the sequence IDs of a text file, in the order they appear, and its number of pairs
+    order = {}
+    n_pairs = 0
+    with open(input_file, 'r') as msa_file:
+        next(msa_file, None)    #Skip the header
+        for line in msa_file:
+            first, second, _ = line.split('\t', 2)
+            order.setdefault(first, len(order))     #Added if it is new
+            order.setdefault(second, len(order))
+            n_pairs += 1
+    return list(order), n_pairs
+
+def read_pairs(input_file, position):   #Function that reads the pairwise scores of a text file in chunks of arrays, with the IDs replaced by their position
     with open(input_file, 'r') as msa_file: #Read the input file
-        header = next(msa_file) #Read the header (we do not need the information in the header)
-        for line in msa_file:   #Read every line in the input file
-            line = line.rstrip().split('\t') # Split the line by its columns and remove new line character
-            if line[0] not in msa_matrix_identity: # If the ID does not exist in the dictionary
-                msa_matrix_identity[line[0]] = {line[0]: '100'} #Add it with an identity percentage of 100 (when sequence is compared against itself)
-                msa_matrix_score[line[0]] = {line[0]: '-'} #Add it without a score ("-") (when compared against itself)
-    #We add the IDs in the second column of each line to the same dictionary so that the output will be a full, symmetrical matrix. The steps are identical to the ones above
-            if line[1] not in msa_matrix_identity:
-                msa_matrix_identity[line[1]] = {line[1]: '100'}
-                msa_matrix_score[line[1]] = {line[1]: '-'}
-    # The identity percentages and the alignment scores are then added to the corresponding dictionaries of dictionaries as values in the nested dictionaries
-            msa_matrix_identity[line[0]][line[1]] = line[2].replace('%', '')
-            msa_matrix_identity[line[1]][line[0]] = line[2].replace('%', '')
-            msa_matrix_score[line[0]][line[1]] = line[3]
-            msa_matrix_score[line[1]][line[0]] = line[3]
-            list_of_scores.append(int(line[3])) #Add the alignment scores to a list
-    #Normalizing the values of the alignment scores to add them to the matrix
-    min_val = min(list_of_scores)   #Find the smallest alignment score
-    max_val = max(list_of_scores)   #Find the largest alignment score
-    for key1 in msa_matrix_score:   #Iterate through all the sequence IDs
-        for key2 in msa_matrix_score[key1]: #Iterate through all the nested dictionaries
-            if msa_matrix_score[key1][key2] != '-': #If a sequence is not compared with itself
-                current_value = float(msa_matrix_score[key1][key2]) #Normalize the score value...
-                msa_matrix_score[key1][key2] = round(100*(current_value + abs(min_val))/(max_val + abs(min_val)), 1)    #...by adding the absolute value of the smallest score to all scores and then dividing by the largest value. The result is multiplied by 100 to be easier to read as a percentage
-            else:   #When the sequence is compared with itself
-                msa_matrix_score[key1][key2] = 100  #Set the alignment score to 100
-    return msa_matrix_identity, msa_matrix_score
+        next(msa_file, None)    #Read the header (we do not need the information in the header)
+        while True:
+            lines = [line.rstrip().split('\t') for line in islice(msa_file, PAIR_CHUNK)]  #Split every line of the chunk by its columns
+            if not lines:
+                return
+            yield (np.array([position[line[0]] for line in lines], dtype=np.int64),
+                   np.array([position[line[1]] for line in lines], dtype=np.int64),
+                   np.array([float(line[2].replace('%', '')) for line in lines], dtype=np.float32),
+                   np.array([int(line[3]) for line in lines], dtype=np.int64))
+
+def fill_text(input_file):      #Function that builds both matrices from a text file of pairs, read twice: once for the IDs, once for the values
+    ids, n_pairs = _text_ids(input_file)
+    identity_matrix, score_matrix = _empty_matrices(ids)
+    for rows, cols, identity, score in read_pairs(input_file, identity_matrix.index):
+        _set_positions(identity_matrix, score_matrix, rows, cols, identity, score)
+    return identity_matrix, score_matrix, n_pairs
+
+def _empty_matrices(ids):       #Function that sets up the identity and raw score matrices of a set of IDs
+    labels = sorted(ids)        #Rows and columns are kept in sorted ID order, as in the output files
+    identity = np.full((len(labels), len(labels)), np.nan, dtype=np.float32)
+    np.fill_diagonal(identity, 100)             #Identity percentage of 100 when a sequence is compared against itself
+    raw_score = np.zeros((len(labels), len(labels)), dtype=np.int32)   #Raw alignment scores, 0 on the diagonal
+    return LabelledMatrix(labels, identity, ids), LabelledMatrix(labels, raw_score, ids)
+
+def _set_pairs(identity_matrix, score_matrix, ids, rows, cols, identity, score):   #Function that sets the values of pairs of IDs in both matrices
+    position = np.array([identity_matrix.index[name] for name in ids], dtype=np.int64)   #Sorted position of each ID
+    _set_positions(identity_matrix, score_matrix, position[rows], position[cols], identity, score)
+
+def _set_positions(identity_matrix, score_matrix, rows, cols, identity, score):   #Function that sets the values of pairs of sorted positions in both matrices
+    identity_matrix.values[rows, cols] = identity_matrix.values[cols, rows] = identity   #Both halves, so that the matrix is symmetrical
+    score_matrix.values[rows, cols] = score_matrix.values[cols, rows] = score
+
+def fill_pairs(ids, rows, cols, identity, score):   #Function that builds both matrices from arrays of pairs
+    identity_matrix, score_matrix = _empty_matrices(ids)
+    _set_pairs(identity_matrix, score_matrix, ids, rows, cols, identity, score)
+    return identity_matrix, score_matrix
+
+def fill_condensed(ids, identity, score):   #Function that builds both matrices from condensed upper triangle arrays
+    identity_matrix, score_matrix = _empty_matrices(ids)
+    position = np.array([identity_matrix.index[name] for name in ids], dtype=np.int64)
+    for i in range(len(ids) - 1):           #Pairs of sequence i with all of the later sequences
+        start = MSA.condensed_index(i, len(ids))
+        end = start + len(ids) - i - 1
+        identity_matrix.values[position[i], position[i + 1:]] = identity[start:end]
+        identity_matrix.values[position[i + 1:], position[i]] = identity[start:end]
+        score_matrix.values[position[i], position[i + 1:]] = score[start:end]
+        score_matrix.values[position[i + 1:], position[i]] = score[start:end]
+    return identity_matrix, score_matrix
+
+def normalize_scores(score_matrix, min_val, max_val):   #Function that normalizes the raw alignment scores
+    #Adding the absolute value of the smallest score to all scores and dividing by the largest value. The result is multiplied by 100 to be easier to read as a percentage
+    denominator = max_val + abs(min_val)
+    if denominator == 0:
+        raise ZeroDivisionError('the alignment scores cannot be normalized')
+    #Raw scores are integers, so every possible normalized value is rounded once in Python and then looked up for all of the cells
+    lookup = np.array([round(100 * (value + abs(min_val)) / denominator, 1) for value in range(min_val, max_val + 1)], dtype=np.float32)
+    with Metrics.stage('normalize_scores') as counters:
+        normalized = np.empty(score_matrix.values.shape, dtype=np.float32)
+        step = max(1, MSA.BLOCK_CELLS // max(1, len(score_matrix)))   #Rows normalized at once, to bound temporary memory
+        for start in range(0, len(score_matrix), step):
+            rows = np.clip(score_matrix.values[start:start + step], min_val, max_val)  #The diagonal may lie outside of the range
+            normalized[start:start + step] = lookup[rows - min_val]
+        np.fill_diagonal(normalized, 100)       #Set the normalized score of a sequence against itself to 100
+        counters['cells'] = normalized.size
+    return LabelledMatrix(score_matrix.labels, normalized, score_matrix.order)
+
+def read_matrices(input_file):  #Function that reads the identity and raw score matrices of the input file (text, or binary .npz from MSA.py)
+    with Metrics.stage('read_matrices') as counters:
+        if MSA.is_npz(input_file):         #Binary files are recognized by their content, not their extension
+            ids, identity, score = MSA.load_pairwise(input_file)
+            matrices = fill_condensed(ids, identity, score)
+            n_pairs = len(score)
+        else:
+            identity_matrix, score_matrix, n_pairs = fill_text(input_file)
+            matrices = identity_matrix, score_matrix
+        counters.update(sequences=len(matrices[0]), pairs=n_pairs)
+    return matrices
+
+def update_matrices(identity_matrix, score_matrix, keys, delta_file):  #Function that adds the pairs of a delta file from MSA.py to existing matrices and the content hash of their IDs (None to start from scratch)
+    ids, rows, cols, identity, score, delta_keys, base_keys = MSA.load_pairwise_delta(delta_file)
+    keys = keys or {}
+    #The delta leaves out the pairs of sequences that are not new, which must be in the matrices with the same content
+    stale = [name for name, key, base_key in zip(ids, delta_keys, base_keys) if key == base_key and keys.get(name) != key]
+    if stale:
+        raise ValueError('{} was computed against other sequences than the kept matrices (such as {}): apply the deltas '
+                         'of the cache in turn, or start again with a new cache and state file'.format(delta_file, stale[0]))
+    new_identity, new_score = _empty_matrices(ids)  #Sequences missing from the delta file are dropped
+    if identity_matrix is not None:                 #The pairs of the sequences already in the matrices are copied
+        kept = [name for name in ids if name in identity_matrix]
+        old_pos = np.array([identity_matrix.index[name] for name in kept], dtype=np.int64)
+        new_pos = np.array([new_identity.index[name] for name in kept], dtype=np.int64)
+        new_identity.values[np.ix_(new_pos, new_pos)] = identity_matrix.values[np.ix_(old_pos, old_pos)]
+        new_score.values[np.ix_(new_pos, new_pos)] = score_matrix.values[np.ix_(old_pos, old_pos)]
+    _set_pairs(new_identity, new_score, ids, rows, cols, identity, score)
+    if np.isnan(new_identity.values).any():         #Pairs that are neither kept nor new
+        raise ValueError('{} does not complete the matrices; rebuild them from a full pairwise file'.format(delta_file))
+    return new_identity, new_score, dict(zip(ids, delta_keys))
+
+def save_state(output_file, identity_matrix, score_matrix, keys=None): #Function that saves the identity and raw score matrices, and the content hash of their IDs when they come from a delta
+    keys = keys or {}
+    with open(output_file, 'wb') as output:     #A file object keeps numpy from adding a suffix
+        np.savez(output, labels=np.array(identity_matrix.labels, dtype=str), order=np.array(identity_matrix.order, dtype=str),
+                 identity=identity_matrix.values, score=score_matrix.values,
+                 keys=np.array([keys.get(name, '') for name in identity_matrix.order], dtype=str))
 
+def load_state(input_file):                     #Function that loads matrices and content hashes saved by save_state
+    with np.load(input_file) as data:
+        labels, order = data['labels'].tolist(), data['order'].tolist()
+        keys = dict(zip(order, data['keys'].tolist())) if 'keys' in data.files else {}  #Unknown content is never a base for a delta
+        return LabelledMatrix(labels, data['identity'], order), LabelledMatrix(labels, data['score'], order), keys
+
+def score_range(score_matrix):                  #Function that finds the smallest and largest raw alignment scores, leaving out the diagonal
+    values = score_matrix.values
+    if len(values) < 2:
+        raise ValueError('at least two sequences are needed to normalize the scores')
+    diagonal = values.diagonal().copy()
+    np.fill_diagonal(values, values[0, 1])      #The diagonal is temporarily set to one of the scores
+    min_val, max_val = int(values.min()), int(values.max())
+    np.fill_diagonal(values, diagonal)
+    return min_val, max_val
+
+def build_matrices(ids, identity, score):   #Function that builds the identity and normalized score matrices from condensed arrays held in memory (see MSA.collect_condensed)
+    identity_matrix, score_matrix = fill_condensed(ids, identity, score)
+    return identity_matrix, normalize_scores(score_matrix, *score_range(score_matrix))
+
+def msa_to_dict(input_file):    #Function that stores data from the input file (text, or binary .npz from MSA.py) into the identity and normalized score matrices
+    with Metrics.stage('msa_to_dict') as counters:
+        identity_matrix, score_matrix = read_matrices(input_file)
+        #Normalizing the values of the alignment scores between the smallest and the largest alignment score
+        score_matrix = normalize_scores(score_matrix, *score_range(score_matrix))
+        counters['sequences'] = len(identity_matrix)
+    return identity_matrix, score_matrix
+
+def _format_row(values, diagonal):          #Function that converts one row of a matrix into text
+    tenths = np.rint(values * 10)
+    if np.all((tenths >= 0) & (tenths <= 1000)):    #Values with one decimal between 0 and 100 are looked up
+        cells = [DECIMAL_TEXT[tenth] for tenth in tenths.astype(np.int64).tolist()]
+    else:
+        cells = [str(round(value, 1)) for value in values.tolist()]
+    cells[diagonal] = '100'                 #A sequence compared against itself
+    return cells
 
 def make_matrix_file(msa_matrix, output_file):
 #Function that writes the matrices to the output files
-    with open(output_file, 'w') as output_matrix:   #Open the output file for writing
-        header = sorted(msa_matrix.keys())  #The first line consists of all the sequence IDs (sorted)
-        header_str = '\t' + '\t'.join(header)   #Separate the IDs by tab in the header
+    with Metrics.stage('make_matrix_file') as counters, open(output_file, 'w') as output_matrix:   #Open the output file for writing
+        header_str = '\t' + '\t'.join(msa_matrix.labels)   #The first line consists of all the sequence IDs (sorted), separated by tab
         output_matrix.write(header_str + '\n')  #Write the header to the output file
-        for key1 in sorted(msa_matrix.keys()):  #Iterate through all the sorted sequence IDs
-            output_matrix.write(key1)           #Write one ID at a time to the output file
-            for key2 in sorted(msa_matrix[key1]):
-                output_matrix.write('\t' + str(msa_matrix[key1][key2])) #Followed by all of the alignment scores between that ID and the other ones, separated by tab
-            output_matrix.write('\n')           #Add a new line
-
-def get_most_similar(msa_dict, name):           #Function for finding the most similar sequence to a specific sequence
-    max_value = 0                               #Variable that stores the value of the largest alignment score
-    max_key = ''                                #Variable that stores the sequence ID corresponding to the largest alignment score
-    for key in msa_dict[name].keys():           #Iterate through all the sequence IDs
-        if key != name:                         #Exclude the case of a sequence being compared with itself
-            if float(msa_dict[name][key]) > max_value:  #If an alignment score is larger than the current largest one being stored in the variable
-                max_value = float(msa_dict[name][key])  #Store the new score as the largest
-                max_key = key                   #Store the corresponding sequence ID
-    return max_key, max_value
+        for i, key1 in enumerate(msa_matrix.labels):    #Iterate through all the sorted sequence IDs
+            #Write one ID at a time, followed by all of the scores between that ID and the other ones, separated by tab
+            output_matrix.write(key1 + '\t' + '\t'.join(_format_row(msa_matrix.values[i], i)) + '\n')
+        counters.update(output_file=output_file, lines_written=len(msa_matrix) + 1, cells=msa_matrix.values.size)
+
+def get_most_similar(msa_matrix, name):         #Function for finding the most similar sequence to a specific sequence
+    row = msa_matrix.row(name).copy()
+    row[msa_matrix.index[name]] = -np.inf       #Exclude the case of a sequence being compared with itself
+    max_value = np.nanmax(row) if len(row) > 1 else 0   #Value of the largest score
+    if not max_value > 0:                       #No score larger than 0
+        return '', 0
+    candidates = np.flatnonzero(row == max_value)   #Ties are broken by the order of the sequences in the input file
+    max_pos = candidates[np.argmin(msa_matrix.rank[candidates])]
+    return msa_matrix.labels[max_pos], round(float(max_value), 1)
+
+class NeighbourIndex:   #The k most similar sequences of every sequence, sorted by decreasing value
+    def __init__(self, labels, order, neighbours, values, metric):
+        self.labels = labels                    #Sorted sequence IDs
+        self.index = {label: i for i, label in enumerate(labels)}   #Row of each sequence ID
+        self.order = order                      #Sequence IDs in the order they appear in the input file
+        self.neighbours = neighbours            #Array (n x k) with the rows of the most similar sequences
+        self.values = values                    #Array (n x k) with the corresponding scores
+        self.metric = metric                    #Matrix the index was built from (identity or score)
+
+    @classmethod
+    def from_matrix(cls, msa_matrix, k, metric='identity'): #Build the index from a LabelledMatrix
+        n = len(msa_matrix)
+        k = max(0, min(k, n - 1))               #A sequence has at most n - 1 neighbours
+        neighbours = np.zeros((n, k), dtype=np.int32)
+        values = np.zeros((n, k), dtype=np.float32)
+        for i in range(n):
+            row = np.nan_to_num(msa_matrix.values[i], nan=-np.inf)
+            row[i] = -np.inf                    #Exclude the case of a sequence being compared with itself
+            rank = msa_matrix.rank.copy()
+            rank[i] = n                         #...also when the other scores are missing
+            if 0 < k < n:                       #Only the scores tied with or above the k-th largest one are sorted
+                threshold = np.partition(row, n - k)[n - k]
+                candidates = np.flatnonzero(row >= threshold)
+            else:
+                candidates = np.arange(n)
+            best = candidates[np.lexsort((rank[candidates], -row[candidates]))[:k]] #Ties are broken by the order of the input file
+            neighbours[i] = best
+            values[i] = msa_matrix.values[i, best]
+        return cls(msa_matrix.labels, msa_matrix.order, neighbours, values, metric)
+
+    @classmethod
+    def load(cls, input_file):                  #Read an index written by save
+        with np.load(input_file) as data:
+            return cls(data['labels'].tolist(), data['order'].tolist(), data['neighbours'],
+                       data['values'], str(data['metric']))
+
+    def save(self, output_file):
+        with open(output_file, 'wb') as output: #A file object keeps numpy from adding a suffix
+            np.savez(output, labels=np.array(self.labels, dtype=str), order=np.array(self.order, dtype=str),
+                     neighbours=self.neighbours, values=self.values, metric=self.metric)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):                         #Iterate through the IDs in input file order
+        return iter(self.order)
+
+    def top(self, name):                        #List of (ID, score) of the most similar sequences to name
+        i = self.index[name]
+        return [(self.labels[j], round(value, 1)) for j, value in zip(self.neighbours[i].tolist(), self.values[i].tolist())]
+
+    def most_similar(self, name):               #Same result as get_most_similar on the matrix of the index
+        top = self.top(name)
+        if not top or not top[0][1] > 0:        #No score larger than 0
+            return '', 0
+        return top[0]
+
+def is_neighbour_index(input_file):             #Check if a file was written by NeighbourIndex.save
+    if not MSA.is_npz(input_file):
+        return False
+    with np.load(input_file) as data:
+        return 'neighbours' in data.files
+
+
+def main(argv=None):   #Function that runs the script with command line arguments (defaults to sys.argv[1:])
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('input_file', help = 'pairwise scores written by MSA.py (text or .npz)')
+    p.add_argument('output_id', help = 'output file for the identity matrix')
+    p.add_argument('output_score', help = 'output file for the normalized score matrix')
+    p.add_argument('-n', dest = 'neighbour_file', help = 'output file for the neighbour index (.npz)')
+    p.add_argument('-k', dest = 'k', type = int, default = 1, help = 'number of most similar sequences in the neighbour index. Default is 1')
+    p.add_argument('-m', dest = 'metric', choices = ['identity', 'score'], default = 'identity', help = 'matrix used for the neighbour index. Default is identity')
+    p.add_argument('-u', dest = 'state_file', help = 'file keeping the identity and raw score matrices between runs (.npz)')
+    p.add_argument('--metrics', dest = 'metrics', help = 'append the metrics of every stage to this file as JSON lines')
+    args = p.parse_args(argv)
+    Metrics.configure(args.metrics)
+    if args.k < 1:
+        p.error('the number of most similar sequences (-k) must be at least 1')
 
+    if MSA.is_pairwise_delta(args.input_file):      #Only the pairs of new sequences are added to the kept matrices
+        previous = load_state(args.state_file) if args.state_file and os.path.exists(args.state_file) else (None, None, None)
+        try:
+            identity, raw_score, keys = update_matrices(*previous, args.input_file)
+        except ValueError as error:
+            p.error(str(error))
+    else:
+        identity, raw_score = read_matrices(args.input_file)    #Calling the function for the input file; two matrices are returned
+        keys = None
+    if args.state_file:
+        save_state(args.state_file, identity, raw_score, keys)
+    score = normalize_scores(raw_score, *score_range(raw_score))   #Normalizing the alignment scores
+    make_matrix_file(identity, args.output_id)      #Write the percentage identity matrix to one output file by calling the proper function
+    make_matrix_file(score, args.output_score)      #Write the normalized score matrix to another output file by calling the proper function
+    if args.neighbour_file:                         #Save the most similar sequences of every sequence
+        matrix = identity if args.metric == 'identity' else score
+        NeighbourIndex.from_matrix(matrix, args.k, args.metric).save(args.neighbour_file)
 
 if __name__ == '__main__':
-    identity, score = msa_to_dict(sys.argv[1])      #Calling the function for the input file; two matrices are returned
-    make_matrix_file(identity, sys.argv[2])         #Write the percentage identity matrix to one output file by calling the proper function
-    make_matrix_file(score, sys.argv[3])            #Write the normalized score matrix to another output file by calling the proper function
+    main()
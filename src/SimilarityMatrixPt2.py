@@ -6,7 +6,7 @@ Date: 2020-10-22
 
 Authors: Mara Vizitiu, Pinar Oncel, Julio Ayala
 
-Description: Script to show the most similar sequences to one or all sequences of an input score file.
+Description: Script to show the most similar sequences to one, several or all sequences of an input score file.
 
 List of user defined functions: N/A
 
@@ -15,30 +15,67 @@ List of modules used that are not explained in the course material:
 
 Procedure:
     1. Import all necessary modules and specifiy command line arguments.
-    2. Use a msa_to_dict function to generate an array (dictionary of dictionaries) containing all of the identity percentages of the pairwise sequence alignments.
-    3. Check the user input and print the most similar sequence to each of the sequences in the array, the most similar sequence to the one specified by the user, or an appropriate message, respectively.
+    2. Load a neighbour index saved by SimilarityMatrix.py, or use the msa_to_dict function to generate the identity (or score) matrix of the pairwise sequence alignments and build the index from it.
+    3. Check the user input and print the most similar sequences to each of the sequences in the index, to the ones specified by the user, or an appropriate message, respectively.
 
-Usage: python SimilarityMatrixPt2.py input_file name_to_compare
+Usage: python SimilarityMatrixPt2.py [-k number] [-m metric] [-s index_file] input_file name_to_compare [name_to_compare ...]
 Example: python SimilarityMatrixPt2.py MSAmtdna.txt ALL
+         python SimilarityMatrixPt2.py -s neighbours_mtdna.npz MSAmtdna.txt ALL
+         python SimilarityMatrixPt2.py neighbours_mtdna.npz Anastasia1 Anastasia2
 
 Arguments: input_file: File with all combinations of pairwise identity and raw scores,
-                        separated by tabs (Same input file used in SimilarityMatrix)
-           name_to_compare: name to compare to the rest of sequences in the file.
-                            Use one id from the file, or 'ALL' for all names.
+                        separated by tabs (Same input file used in SimilarityMatrix, text or .npz),
+                        or a neighbour index saved by SimilarityMatrix.py or with -s
+           name_to_compare: names to compare to the rest of sequences in the file.
+                            Use ids from the file, or 'ALL' for all names.
+           -k number: number of most similar sequences to show. Default is 1. A neighbour index given as
+                      input_file must keep at least this many sequences
+           -m metric: matrix used to rank the sequences, identity or score. Default is identity.
+                      Ignored when input_file is a neighbour index
+           -s index_file: save the neighbour index built from input_file, to answer later queries without rebuilding the matrices
 
 '''
 
 import SimilarityMatrix as sm #Import the previously used script
-import sys
-
-name = sys.argv[2]          #Define user input as the third argument
-identity = sm.msa_to_dict(sys.argv[1])  #Create an array of identity percentage values using the same function as in the previous part of the exercise
-if name.upper() == 'ALL':   #If the name input by the user is "ALL"
-    for key in identity[0]: #Iterate through all the identity percentages
-        max_name, max_score = sm.get_most_similar(identity[0], key) #Retrieve the most similar hit from the array, and the corresponding score
-        print('{} is the most similar to {} with a score of {}%'.format(key, max_name, max_score))  #Print all of the sequences and their corresponding most similar sequence, one pair at a time
-elif name in identity[0]:   #If a sequence name is given
-    max_name, max_score = sm.get_most_similar(identity[0], name) #Use the identity matrix to find the most similar sequence to the input
-    print('{} is the most similar to {} with a score of {}'.format(name, max_name, max_score))  #Print the most similar sequence and the identity percentage
-else:       #If the input name is not one of the sequence names
-    print('This name is not in the matrix. Please check the sequence id')   #Print relevant message to the user
+import argparse
+
+p = argparse.ArgumentParser(description=__doc__,
+                            formatter_class=argparse.RawDescriptionHelpFormatter)
+p.add_argument('input_file', help = 'pairwise scores or neighbour index')
+p.add_argument('names', nargs = '+', metavar = 'name_to_compare', help = "sequence ids, or 'ALL'")
+p.add_argument('-k', dest = 'k', type = int, default = 1, help = 'number of most similar sequences. Default is 1')
+p.add_argument('-m', dest = 'metric', choices = ['identity', 'score'], default = 'identity', help = 'matrix used for the ranking. Default is identity')
+p.add_argument('-s', dest = 'index_file', help = 'file to save the neighbour index to')
+args = p.parse_args()
+if args.k < 1:
+    p.error('the number of most similar sequences (-k) must be at least 1')
+
+if sm.is_neighbour_index(args.input_file):  #A precomputed index is loaded as it is
+    index = sm.NeighbourIndex.load(args.input_file)
+    kept = index.neighbours.shape[1]        #Number of most similar sequences kept per sequence
+    if kept < min(args.k, len(index.labels) - 1):
+        p.error('{} only keeps the {} most similar sequences of each sequence, rebuild it with -k {}'.format(
+            args.input_file, kept, args.k))
+else:
+    identity, score = sm.msa_to_dict(args.input_file)  #Create the matrices using the same function as in the previous part of the exercise
+    index = sm.NeighbourIndex.from_matrix(identity if args.metric == 'identity' else score, args.k, args.metric)
+    if args.index_file:     #Save the index for the next queries
+        index.save(args.index_file)
+
+def show(name, percent):    #Print the most similar sequences to one sequence
+    unit = '%' if index.metric == 'identity' else ''    #Normalized scores are not percentages
+    if args.k == 1:
+        max_name, max_score = index.most_similar(name) #Retrieve the most similar hit from the index, and the corresponding score
+        print('{} is the most similar to {} with a score of {}{}'.format(name, max_name, max_score, percent and unit))
+    else:
+        hits = ', '.join('{} ({}{})'.format(hit, value, unit) for hit, value in index.top(name)[:args.k])
+        print('{} is the most similar to: {}'.format(name, hits))
+
+for name in args.names:
+    if name.upper() == 'ALL':   #If the name input by the user is "ALL"
+        for key in index:       #Print all of the sequences and their most similar sequences, one at a time
+            show(key, '%')
+    elif name in index:         #If a sequence name is given
+        show(name, '')
+    else:       #If the input name is not one of the sequence names
+        print('This name is not in the matrix. Please check the sequence id')   #Print relevant message to the user